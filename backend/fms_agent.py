@@ -3,33 +3,39 @@ FMS Agent - Agentic Flow Management System
 Adapted from main_cli.py (v3.0) for FastAPI backend integration
 """
 
-import os
-import json
+import asyncio
 import logging
+import threading
+import time
 from datetime import datetime
-from pathlib import Path
-from typing import Optional, Callable, Dict, Any, List
-import re
-
-from dotenv import load_dotenv
-from pydantic import BaseModel, Field
-from openai import OpenAI
-
-# Load environment
-load_dotenv()
+from typing import Optional, Callable, Dict, Any
 
 logger = logging.getLogger(__name__)
 
-# Import schemas and functions from main_cli
-import sys
-sys.path.append(str(Path(__file__).parent))
+# Import schemas and functions from main_cli (which also loads the environment)
 import main_cli
 from main_cli import (
-    FlowSchema, FormulaPlan, ColumnInfo, SheetSchema, WorkflowStage, ColumnType,
+    FlowSchema, FormulaPlan,
     GoogleServicesManager, GoogleSheetsManager,
-    JSONCleaner, ProjectManager, AgentState
+    ProjectManager, AgentState
 )
 
+# Authenticated once per process and shared by all agents
+_google_manager: Optional[GoogleServicesManager] = None
+_google_lock = threading.Lock()
+
+def _get_google_services() -> tuple:
+    """Return (drive, sheets) clients, authenticating only on first use"""
+    global _google_manager
+    with _google_lock:
+        if _google_manager is None:
+            manager = GoogleServicesManager()
+            manager.authenticate()
+            _google_manager = manager
+    
+    # Fresh clients per workflow: the underlying HTTP connection is not thread-safe
+    return _google_manager.build_services()
+
 class FMSAgent:
     """
     Production FMS Agent with real-time logging.
@@ -41,20 +47,32 @@ class FMSAgent:
         prompt: str,
         model: str = "gpt-4o",
         temperature: float = 1.0,
-        log_callback: Optional[Callable] = None
+        log_callback: Optional[Callable] = None,
+        structure_model: Optional[str] = None,
+        formula_model: Optional[str] = None
     ):
         self.prompt = prompt
-        # We update the main_cli config if a specific model/temp is requested
-        main_cli.Config.OPENAI_MODEL = model
-        # Note: main_cli.py doesn't currently support passing temperature to LLMClient.invoke easily
-        # but it reads it from environment if we added it there.
+        # Passed per call instead of patching main_cli.Config, so concurrent
+        # agents with different settings don't overwrite each other
+        self.model = model
+        self.temperature = temperature
+        
+        # Per-stage overrides (e.g. a smaller model for the template-driven structure step)
+        self.structure_model = structure_model or model
+        self.formula_model = formula_model or model
         
         self.log_callback = log_callback
         
         # State
         self.state = AgentState(prompt=prompt)
         
-        logger.info(f"FMS Agent initialized: model={model}, temp={temperature}")
+        # Blank spreadsheet creation, started as soon as the system name is streamed
+        self._spreadsheet_task: Optional[asyncio.Task] = None
+        
+        logger.info(
+            f"FMS Agent initialized: structure_model={self.structure_model}, "
+            f"formula_model={self.formula_model}, temp={temperature}"
+        )
     
     async def log(self, level: str, stage: str, message: str, data: dict = None):
         """Log message and broadcast to WebSocket clients"""
@@ -70,8 +88,18 @@ class FMSAgent:
         """Delegate to main_cli.structure_agent"""
         await self.log("INFO", "structure", "🏗️ Structure Agent: Designing system with workflow stages")
         
-        # Use main_cli's agent logic
-        result = main_cli.structure_agent(self.state)
+        def on_system_name(name: str):
+            # The spreadsheet only needs a title, so create it while the rest of the structure streams
+            self._spreadsheet_task = asyncio.create_task(self._create_blank_spreadsheet(name))
+        
+        # Use main_cli's agent logic (async variant, so the event loop keeps serving other requests)
+        result = await main_cli.astructure_agent(
+            self.state,
+            model=self.structure_model,
+            temperature=self.temperature,
+            on_system_name=on_system_name,
+            save=False  # written by execute() alongside the formula call
+        )
         
         if "errors" in result:
             error_msg = result["errors"][0]
@@ -94,8 +122,16 @@ class FMSAgent:
         
         await self.log("INFO", "formula", "⚙️ Formula Agent: Creating stage-based calculations")
         
-        # Use main_cli's agent logic
-        result = main_cli.formula_agent(self.state)
+        async def on_progress(count: int):
+            await self.log("INFO", "formula", f"✏️ {count} formula(s) generated so far...")
+        
+        # Use main_cli's agent logic (async variant, so the event loop keeps serving other requests)
+        result = await main_cli.aformula_agent(
+            self.state,
+            model=self.formula_model,
+            temperature=self.temperature,
+            on_progress=on_progress
+        )
         
         if "errors" in result:
             error_msg = result["errors"][0]
@@ -108,59 +144,116 @@ class FMSAgent:
         
         return self.state.formulas
     
-    async def create_google_sheet(self) -> tuple:
-        """Create Google Sheet with Stage Formatting using main_cli managers"""
+    async def _create_blank_spreadsheet(self, title: Optional[str] = None) -> tuple:
+        """Authenticate and create the empty spreadsheet (only needs the flow's system name)"""
         await self.log("INFO", "sheets", "📊 Creating Google Spreadsheet with Stage Formatting...")
         
-        # Authenticate using main_cli managers
-        google_manager = GoogleServicesManager()
-        drive, sheets = google_manager.authenticate()
+        # Authenticate using main_cli managers (blocking Google client calls run in a worker thread)
+        drive, sheets = await asyncio.to_thread(_get_google_services)
         
         sheets_manager = GoogleSheetsManager(drive, sheets)
         
         # Create spreadsheet
-        spreadsheet_id = sheets_manager.create_spreadsheet(self.state.flow.system_name)
+        spreadsheet_id = await asyncio.to_thread(
+            sheets_manager.create_spreadsheet, title or self.state.flow.system_name
+        )
         
         await self.log("INFO", "sheets", f"Spreadsheet created: {spreadsheet_id}")
         
+        return spreadsheet_id, sheets_manager
+    
+    async def _discard_spreadsheet(self) -> None:
+        """Delete the spreadsheet created for a failed run, waiting for an in-flight creation"""
+        task, self._spreadsheet_task = self._spreadsheet_task, None
+        if task is None:
+            return
+        
+        # cancel() can't stop a create already running in a worker thread, so let it finish;
+        # return_exceptions also retrieves a creation error nobody else awaited
+        (result,) = await asyncio.gather(task, return_exceptions=True)
+        if isinstance(result, BaseException):
+            return
+        
+        spreadsheet_id, sheets_manager = result
+        try:
+            await asyncio.to_thread(sheets_manager.delete_spreadsheet, spreadsheet_id)
+            await self.log("INFO", "sheets", f"Removed spreadsheet from failed run: {spreadsheet_id}")
+        except Exception as e:
+            await self.log("WARNING", "sheets", f"Could not remove spreadsheet {spreadsheet_id}: {e}")
+    
+    async def _apply_sheet_content(self, spreadsheet_id: str, sheets_manager: GoogleSheetsManager) -> None:
+        """Add sheets, stage formatting and formulas to an existing spreadsheet"""
         # Setup sheets with stage formatting
-        sheets_manager.setup_sheets(spreadsheet_id, self.state.flow)
+        await asyncio.to_thread(sheets_manager.setup_sheets, spreadsheet_id, self.state.flow)
         
         # Apply formulas
-        sheets_manager.apply_formulas(spreadsheet_id, self.state.flow, self.state.formulas)
+        await asyncio.to_thread(
+            sheets_manager.apply_formulas, spreadsheet_id, self.state.flow, self.state.formulas
+        )
         
         await self.log("INFO", "sheets", "✅ Google Sheet ready with workflow stages!")
-        
+    
+    async def create_google_sheet(self) -> tuple:
+        """Create Google Sheet with Stage Formatting using main_cli managers"""
+        spreadsheet_id, sheets_manager = await self._create_blank_spreadsheet()
+        await self._apply_sheet_content(spreadsheet_id, sheets_manager)
         return spreadsheet_id, sheets_manager
     
     async def execute(self) -> Dict[str, Any]:
-        """Execute complete FMS workflow"""
-        start_time = datetime.now()
+        """
+        Execute complete FMS workflow.
+        
+        The formula phase depends on the flow structure, so phases stay ordered,
+        except that the blank spreadsheet is created alongside the formula call.
+        LLM calls are awaited so many workflows can run concurrently on one worker.
+        """
+        start_time = time.perf_counter()
+        # One timestamp for both the folder name and metadata created_at
+        created_at = datetime.now()
         
         try:
             # Create project folder (using main_cli's ProjectManager)
-            self.state.project_folder = ProjectManager.create_project_folder(self.prompt)
+            self.state.project_folder = await asyncio.to_thread(
+                ProjectManager.create_project_folder, self.prompt, created_at
+            )
             await self.log("INFO", "setup", f"Project folder: {self.state.project_folder.name}")
             
             # Phase 1: Structure
             await self.structure_agent()
             
-            # Phase 2: Formulas
-            await self.formula_agent()
+            # Phase 2: Formulas, while the blank spreadsheet is created and the structure is saved
+            # (creation only needs the system name, so its round-trip hides under the LLM call;
+            # it may already have been started while the structure was streaming)
+            if self._spreadsheet_task is None:
+                self._spreadsheet_task = asyncio.create_task(self._create_blank_spreadsheet())
+            # Wait for all three even if one fails, so nothing is left running;
+            # the except below then deletes the spreadsheet if anything failed
+            results = await asyncio.gather(
+                self._spreadsheet_task,
+                self.formula_agent(),
+                asyncio.to_thread(main_cli.save_flow_structure, self.state.project_folder, self.state.flow),
+                return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            spreadsheet_id, sheets_manager = results[0]
             
-            # Phase 3: Google Sheets
-            spreadsheet_id, _ = await self.create_google_sheet()
+            # Phase 3: Google Sheets content
+            await self._apply_sheet_content(spreadsheet_id, sheets_manager)
             
             # Calculate execution time
-            execution_time = (datetime.now() - start_time).total_seconds()
+            execution_time = time.perf_counter() - start_time
             
             # Save metadata (using main_cli's ProjectManager)
-            metadata = ProjectManager.save_metadata(
+            metadata = await asyncio.to_thread(
+                ProjectManager.save_metadata,
                 self.state.project_folder,
                 self.prompt,
                 spreadsheet_id,
                 self.state.flow,
-                execution_time
+                execution_time,
+                created_at
             )
             
             await self.log("INFO", "complete", "🎉 Workflow creation complete!", {
@@ -181,4 +274,6 @@ class FMSAgent:
             
         except Exception as e:
             await self.log("ERROR", "error", f"❌ Workflow failed: {str(e)}")
+            # Don't leave an empty spreadsheet behind in the user's Drive
+            await self._discard_spreadsheet()
             raise
\ No newline at end of file
@@ -0,0 +1,178 @@
+"""
+LLM Cache - Response cache for agent LLM calls
+Exact hits are keyed by a SHA256 of the canonicalized request payload;
+semantic hits reuse the response of a near-duplicate prompt (embedding cosine similarity).
+"""
+
+import asyncio
+import hashlib
+import logging
+import math
+import operator
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Protocol, Tuple
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+EmbedFn = Callable[[str], Awaitable[List[float]]]
+
+
+class CacheBackend(Protocol):
+    """Storage for cached LLM responses"""
+
+    async def get(self, key: str) -> Optional[str]:
+        ...
+
+    async def set(self, key: str, value: str) -> None:
+        ...
+
+
+class MemoryCacheBackend:
+    """In-process LRU backend"""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, str]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[str]:
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+
+class FileCacheBackend:
+    """One file per entry - survives restarts and is shared between workers"""
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.txt"
+
+    @staticmethod
+    def _read(path: Path) -> Optional[str]:
+        try:
+            return path.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._read, self._path(key))
+
+    @staticmethod
+    def _write(path: Path, value: str) -> None:
+        # Temp file + os.replace so a concurrent get() (or another worker) never reads a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    async def set(self, key: str, value: str) -> None:
+        await asyncio.to_thread(self._write, self._path(key), value)
+
+
+class LLMCache:
+    """Exact + semantic cache in front of an LLM call"""
+
+    def __init__(
+        self,
+        backend: CacheBackend,
+        embed: Optional[EmbedFn] = None,
+        semantic_threshold: float = 0.92,
+        max_semantic_entries: int = 256
+    ):
+        self.backend = backend
+        self.embed = embed
+        self.semantic_threshold = semantic_threshold
+        self.max_semantic_entries = max_semantic_entries
+        # (scope, unit-length embedding, exact key) - kept in memory only
+        self._index: List[Tuple[str, List[float], str]] = []
+
+    @staticmethod
+    def make_key(payload: Dict[str, Any]) -> str:
+        """SHA256 of the canonicalized payload"""
+        canonical = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+        return hashlib.sha256(canonical).hexdigest()
+
+    async def get_or_call(
+        self,
+        payload: Dict[str, Any],
+        call: Callable[[], Awaitable[str]],
+        semantic_text: Optional[str] = None
+    ) -> str:
+        """
+        Return the cached response for payload, or run call() and cache its result.
+
+        semantic_text opts into similarity matching; it is only compared against
+        entries whose payload is identical apart from the "user" prompt.
+        """
+        key = self.make_key(payload)
+        cached = await self.backend.get(key)
+        if cached is not None:
+            logger.info("LLM cache hit (exact)")
+            return cached
+
+        vector = None
+        scope = None
+        if semantic_text and self.embed:
+            scope = self.make_key({k: v for k, v in payload.items() if k != "user"})
+            vector = await self._embed(semantic_text)
+            if vector is not None:
+                match = self._nearest(scope, vector)
+                if match is not None:
+                    cached = await self.backend.get(match)
+                    if cached is not None:
+                        logger.info("LLM cache hit (semantic)")
+                        return cached
+
+        response = await call()
+        await self.backend.set(key, response)
+
+        if vector is not None:
+            self._index.append((scope, vector, key))
+            if len(self._index) > self.max_semantic_entries:
+                self._index.pop(0)
+
+        return response
+
+    async def _embed(self, text: str) -> Optional[List[float]]:
+        """Embed and normalize text; semantic lookup is skipped if embedding fails"""
+        try:
+            vector = await self.embed(text)
+        except Exception as e:
+            logger.warning(f"Semantic cache embedding failed: {e}")
+            return None
+
+        norm = math.sqrt(sum(map(operator.mul, vector, vector)))
+        if not norm:
+            return None
+        return [x / norm for x in vector]
+
+    def _nearest(self, scope: str, vector: List[float]) -> Optional[str]:
+        """Key of the most similar indexed prompt above the threshold"""
+        best_key = None
+        best_score = self.semantic_threshold
+        for entry_scope, entry_vector, entry_key in self._index:
+            if entry_scope != scope:
+                continue
+            score = sum(map(operator.mul, vector, entry_vector))
+            if score >= best_score:
+                best_key, best_score = entry_key, score
+        return best_key
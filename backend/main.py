@@ -4,23 +4,26 @@ Production-ready Flow Management System with real-time agent logs
 """
 
 import os
-import json
+import sys
+import time
+import shutil
 import asyncio
 import logging
+import uuid
+from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Union
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict
+import orjson
 
-# Import the FMS agent logic
-import sys
-sys.path.append(str(Path(__file__).parent))
+# Import the FMS agent logic (backend/ is on sys.path for both `python main.py` and `uvicorn main:app`)
 from fms_agent import FMSAgent, AgentState
 
 # Logging setup
@@ -32,34 +35,91 @@ logging.basicConfig(
     ]
 )
 # Fix Windows encoding for emojis
-import sys
 if sys.platform == 'win32':
     sys.stdout.reconfigure(encoding='utf-8')
     sys.stderr.reconfigure(encoding='utf-8')
 
 logger = logging.getLogger(__name__)
 
+# Log events are the bulk of WebSocket traffic: a fixed-field record instead of a
+# per-event dict (orjson serializes dataclasses natively)
+@dataclass
+class LogMessage:
+    __slots__ = ("type", "job_id", "level", "stage", "message", "data", "timestamp")
+    type: str
+    job_id: str
+    level: str
+    stage: str
+    message: str
+    data: Optional[dict]
+    timestamp: str
+
 # WebSocket connection manager
+CLIENT_QUEUE_SIZE = 256
+WS_PING_INTERVAL = 20.0  # Protocol-level keep-alive (seconds); uvicorn's CLI default is the same
+WS_PING_TIMEOUT = 20.0
+# libuv event loop + C HTTP parser (both ship with uvicorn[standard]); uvloop has no Windows build
+UVICORN_LOOP = "asyncio" if sys.platform == "win32" else "uvloop"
+UVICORN_HTTP = "httptools"
+
 class ConnectionManager:
+    """
+    Each client gets an outbound queue drained by its own writer task, so broadcasting
+    never waits on a socket and one slow client cannot hold up the others.
+    """
+    
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Dict[WebSocket, asyncio.Queue] = {}
+        self._writers: Dict[WebSocket, asyncio.Task] = {}
     
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        self.active_connections[websocket] = queue
+        self._writers[websocket] = asyncio.create_task(self._writer(websocket, queue))
         logger.info(f"WebSocket connected. Total connections: {len(self.active_connections)}")
     
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        # Idempotent: a client can be dropped by its writer and again by its own handler
+        if self.active_connections.pop(websocket, None) is None:
+            return
+        writer = self._writers.pop(websocket, None)
+        if writer and writer is not asyncio.current_task():
+            writer.cancel()
         logger.info(f"WebSocket disconnected. Total connections: {len(self.active_connections)}")
     
-    async def broadcast(self, message: dict):
+    async def _writer(self, websocket: WebSocket, queue: asyncio.Queue):
+        """Send queued payloads to one client until it fails or disconnects"""
+        try:
+            while True:
+                payload = await queue.get()
+                await websocket.send_text(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error sending to client: {e}")
+            self.disconnect(websocket)
+    
+    def send(self, websocket: WebSocket, payload: str) -> bool:
+        """Queue a text frame for one client; a client whose queue is full is dropped"""
+        queue = self.active_connections.get(websocket)
+        if queue is None:
+            return False
+        try:
+            queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            logger.warning("WebSocket client is not keeping up; dropping connection")
+            self.disconnect(websocket)
+            asyncio.create_task(websocket.close(code=1008))
+            return False
+    
+    async def broadcast(self, message: Union[dict, LogMessage]):
         """Broadcast message to all connected clients"""
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except Exception as e:
-                logger.error(f"Error broadcasting to client: {e}")
+        # Serialize once for all clients; sent as text because the frontend JSON.parses event.data
+        payload = orjson.dumps(message).decode()
+        for websocket in tuple(self.active_connections):
+            self.send(websocket, payload)
 
 manager = ConnectionManager()
 
@@ -78,13 +138,16 @@ async def lifespan(app: FastAPI):
     
     # Shutdown
     logger.info("👋 FMS Backend shutting down...")
+    for task in _jobs.values():
+        task.cancel()
 
 # FastAPI app
 app = FastAPI(
     title="Flow Management System API",
     description="Production-ready agentic FMS with real-time logs",
     version="2.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware
@@ -101,8 +164,12 @@ class WorkflowRequest(BaseModel):
     prompt: str
     model: Optional[str] = "gpt-4o"
     temperature: Optional[float] = 1.0
+    structure_model: Optional[str] = None  # Defaults to model
+    formula_model: Optional[str] = None    # Defaults to model
 
 class WorkflowResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+    
     success: bool
     message: str
     project_id: Optional[str] = None
@@ -113,6 +180,21 @@ class WorkflowResponse(BaseModel):
     sheets_count: Optional[int] = None
     formulas_count: Optional[int] = None
 
+class WorkflowJobResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+    
+    success: bool
+    message: str
+    job_id: str
+
+class WorkflowStatusResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+    
+    job_id: str
+    status: str  # running | completed | failed
+    result: Optional[WorkflowResponse] = None
+    error: Optional[str] = None
+
 # Health check
 @app.get("/api/health")
 async def health_check():
@@ -126,67 +208,84 @@ async def health_check():
 # WebSocket endpoint for real-time logs
 @app.websocket("/ws/logs")
 async def websocket_logs(websocket: WebSocket):
+    # Liveness is handled by the server's protocol-level pings (uvicorn ws_ping_interval);
+    # this loop only waits for the disconnect. Incoming messages are ignored.
     await manager.connect(websocket)
     try:
         while True:
-            # Keep connection alive
-            data = await websocket.receive_text()
-            if data == "ping":
-                await websocket.send_json({"type": "pong"})
+            await websocket.receive_text()
     except WebSocketDisconnect:
         manager.disconnect(websocket)
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
         manager.disconnect(websocket)
 
-# Create workflow endpoint
-@app.post("/api/workflow/create", response_model=WorkflowResponse)
-async def create_workflow(request: WorkflowRequest):
-    """
-    Create a new workflow using the FMS agent
-    Streams real-time logs to connected WebSocket clients
-    """
+# Workflow jobs
+# Workflows run as background tasks so the POST returns immediately; progress and the
+# final result are pushed over /ws/logs (tagged with job_id) and can also be polled.
+JOB_RETENTION_SECONDS = 3600  # How long a finished job's status stays pollable
+
+_jobs: Dict[str, asyncio.Task] = {}
+
+def _on_job_done(job_id: str, task: asyncio.Task):
+    # Mark the exception as retrieved (it was already logged and broadcast), then
+    # forget the job once its retention window has passed
+    if not task.cancelled():
+        task.exception()
+    asyncio.get_running_loop().call_later(JOB_RETENTION_SECONDS, _jobs.pop, job_id, None)
+
+async def _run_workflow(job_id: str, request: WorkflowRequest) -> WorkflowResponse:
+    """Run the FMS agent for one job, streaming real-time logs to WebSocket clients"""
     try:
-        start_time = datetime.now()
+        start_time = time.perf_counter()
         
         # Log start
-        await manager.broadcast({
-            "type": "log",
-            "level": "info",
-            "stage": "init",
-            "message": f"🚀 Starting workflow creation: {request.prompt}",
-            "timestamp": datetime.now().isoformat()
-        })
+        await manager.broadcast(LogMessage(
+            type="log",
+            job_id=job_id,
+            level="info",
+            stage="init",
+            message=f"🚀 Starting workflow creation: {request.prompt}",
+            data=None,
+            timestamp=datetime.now().isoformat()
+        ))
         
         # Create FMS agent with WebSocket log callback
         async def log_callback(level: str, stage: str, message: str, data: dict = None):
             """Callback to broadcast logs to WebSocket clients"""
-            await manager.broadcast({
-                "type": "log",
-                "level": level,
-                "stage": stage,
-                "message": message,
-                "data": data,
-                "timestamp": datetime.now().isoformat()
-            })
+            await manager.broadcast(LogMessage(
+                type="log",
+                job_id=job_id,
+                level=level,
+                stage=stage,
+                message=message,
+                data=data,
+                timestamp=datetime.now().isoformat()
+            ))
         
         # Initialize agent
         agent = FMSAgent(
             prompt=request.prompt,
             model=request.model,
             temperature=request.temperature,
-            log_callback=log_callback
+            log_callback=log_callback,
+            structure_model=request.structure_model,
+            formula_model=request.formula_model
         )
         
         # Execute workflow
         result = await agent.execute()
         
         # Calculate execution time
-        execution_time = (datetime.now() - start_time).total_seconds()
+        execution_time = time.perf_counter() - start_time
+        
+        # metadata.json is written inside the project folder, which doesn't bump the projects dir mtime
+        invalidate_projects_cache()
         
         # Broadcast completion
         await manager.broadcast({
             "type": "complete",
+            "job_id": job_id,
             "message": "✅ Workflow created successfully!",
             "result": result,
             "timestamp": datetime.now().isoformat()
@@ -204,38 +303,118 @@ async def create_workflow(request: WorkflowRequest):
             formulas_count=result.get("formulas_count")
         )
         
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
         logger.error(f"Workflow creation failed: {e}", exc_info=True)
         
         # Broadcast error
         await manager.broadcast({
             "type": "error",
+            "job_id": job_id,
             "message": f"❌ Error: {str(e)}",
             "timestamp": datetime.now().isoformat()
         })
         
-        raise HTTPException(status_code=500, detail=str(e))
+        raise
+
+# Create workflow endpoint
+@app.post("/api/workflow/create", response_model=WorkflowJobResponse, status_code=202)
+async def create_workflow(request: WorkflowRequest):
+    """
+    Start a new workflow using the FMS agent and return its job_id
+    Real-time logs and the result are broadcast to connected WebSocket clients
+    """
+    job_id = uuid.uuid4().hex
+    task = asyncio.create_task(_run_workflow(job_id, request))
+    _jobs[job_id] = task
+    task.add_done_callback(lambda t: _on_job_done(job_id, t))
+    
+    return WorkflowJobResponse(
+        success=True,
+        message="Workflow started",
+        job_id=job_id
+    )
+
+# Workflow status endpoint
+@app.get("/api/workflow/{job_id}", response_model=WorkflowStatusResponse)
+async def get_workflow_status(job_id: str):
+    """Poll a workflow job started by /api/workflow/create"""
+    task = _jobs.get(job_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    if not task.done():
+        return WorkflowStatusResponse(job_id=job_id, status="running")
+    if task.cancelled():
+        return WorkflowStatusResponse(job_id=job_id, status="failed", error="Cancelled")
+    if task.exception() is not None:
+        return WorkflowStatusResponse(job_id=job_id, status="failed", error=str(task.exception()))
+    return WorkflowStatusResponse(job_id=job_id, status="completed", result=task.result())
 
 # List projects
+# ((projects dir mtime_ns, entry count), projects) - rebuilt when a project folder is added/removed
+# or when a workflow finishes writing its metadata
+_projects_cache: Optional[Tuple[Tuple[int, int], List[Dict[str, Any]]]] = None
+# Bumped on every invalidation, so a scan that overlapped one doesn't store its stale result
+_projects_generation = 0
+
+def invalidate_projects_cache():
+    global _projects_cache, _projects_generation
+    _projects_cache = None
+    _projects_generation += 1
+
+def _read_json(path: Union[str, Path]) -> Optional[Any]:
+    """Parse a JSON file, or None if it doesn't exist"""
+    try:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+def _read_text(path: Path) -> Optional[str]:
+    try:
+        return path.read_text(encoding='utf-8')
+    except FileNotFoundError:
+        return None
+
+def _list_project_folders(projects_dir: Path) -> List[Tuple[str, str]]:
+    """(name, path) of project folders, newest first - DirEntry carries the type, so no extra stat"""
+    with os.scandir(projects_dir) as entries:
+        folders = [(e.name, e.path) for e in entries if e.is_dir()]
+    folders.sort(reverse=True)
+    return folders
+
+async def _scan_projects(projects_dir: Path) -> List[Dict[str, Any]]:
+    """Read metadata of every project folder concurrently in worker threads, newest first"""
+    folders = await asyncio.to_thread(_list_project_folders, projects_dir)
+    metadata = await asyncio.gather(
+        *(asyncio.to_thread(_read_json, os.path.join(path, "metadata.json")) for _, path in folders)
+    )
+    return [
+        {"folder": name, "metadata": meta}
+        for (name, _), meta in zip(folders, metadata)
+        if meta is not None
+    ]
+
 @app.get("/api/projects")
 async def list_projects():
     """List all created projects"""
+    global _projects_cache
     try:
         projects_dir = Path("projects")
         if not projects_dir.exists():
             return {"projects": []}
         
-        projects = []
-        for project_folder in sorted(projects_dir.iterdir(), reverse=True):
-            if project_folder.is_dir():
-                metadata_file = project_folder / "metadata.json"
-                if metadata_file.exists():
-                    with open(metadata_file, 'r', encoding='utf-8') as f:
-                        metadata = json.load(f)
-                        projects.append({
-                            "folder": project_folder.name,
-                            "metadata": metadata
-                        })
+        # (st_mtime_ns, entry count) - the count catches changes within the mtime granularity
+        key = (projects_dir.stat().st_mtime_ns, len(os.listdir(projects_dir)))
+        if _projects_cache is not None and _projects_cache[0] == key:
+            projects = _projects_cache[1]
+        else:
+            generation = _projects_generation
+            projects = await _scan_projects(projects_dir)
+            if generation == _projects_generation:
+                _projects_cache = (key, projects)
         
         return {"projects": projects, "count": len(projects)}
     
@@ -253,28 +432,27 @@ async def get_project(project_id: str):
         if not project_folder.exists():
             raise HTTPException(status_code=404, detail="Project not found")
         
-        # Load all project files
-        metadata_file = project_folder / "metadata.json"
-        flow_file = project_folder / "schemas" / "flow_structure.json"
-        formula_file = project_folder / "schemas" / "formula_plan.json"
-        readme_file = project_folder / "README.md"
+        # Load all project files concurrently
+        metadata, flow_structure, formula_plan, readme = await asyncio.gather(
+            asyncio.to_thread(_read_json, project_folder / "metadata.json"),
+            asyncio.to_thread(_read_json, project_folder / "schemas" / "flow_structure.json"),
+            asyncio.to_thread(_read_json, project_folder / "schemas" / "formula_plan.json"),
+            asyncio.to_thread(_read_text, project_folder / "README.md")
+        )
         
         result = {"project_id": project_id}
         
-        if metadata_file.exists():
-            with open(metadata_file, 'r', encoding='utf-8') as f:
-                result["metadata"] = json.load(f)
+        if metadata is not None:
+            result["metadata"] = metadata
         
-        if flow_file.exists():
-            with open(flow_file, 'r', encoding='utf-8') as f:
-                result["flow_structure"] = json.load(f)
+        if flow_structure is not None:
+            result["flow_structure"] = flow_structure
         
-        if formula_file.exists():
-            with open(formula_file, 'r', encoding='utf-8') as f:
-                result["formula_plan"] = json.load(f)
+        if formula_plan is not None:
+            result["formula_plan"] = formula_plan
         
-        if readme_file.exists():
-            result["readme"] = readme_file.read_text(encoding='utf-8')
+        if readme is not None:
+            result["readme"] = readme
         
         return result
     
@@ -294,8 +472,9 @@ async def delete_project(project_id: str):
         if not project_folder.exists():
             raise HTTPException(status_code=404, detail="Project not found")
         
-        import shutil
-        shutil.rmtree(project_folder)
+        # Recursive delete runs in a worker thread so other requests keep being served
+        await asyncio.to_thread(shutil.rmtree, project_folder)
+        invalidate_projects_cache()
         
         return {"success": True, "message": f"Project {project_id} deleted"}
     
@@ -321,5 +500,10 @@ if __name__ == "__main__":
         host="0.0.0.0",
         port=8000,
         reload=False,  # Disabled to prevent constant reloading from log files
-        log_level="info"
+        log_level="info",
+        loop=UVICORN_LOOP,
+        http=UVICORN_HTTP,
+        ws="websockets",
+        ws_ping_interval=WS_PING_INTERVAL,
+        ws_ping_timeout=WS_PING_TIMEOUT
     )
\ No newline at end of file
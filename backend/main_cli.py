@@ -9,18 +9,30 @@ Version: 3.0
 """
 
 import os
-import json
+import asyncio
 import re
+import time
+import functools
+import random
+import tempfile
 import argparse
 import logging
+import concurrent.futures
+import logging.handlers
 from datetime import datetime
 from pathlib import Path
-from typing import List, Optional, Dict, Any, Tuple
+from typing import List, Optional, Dict, Any, Tuple, Type, Callable, AsyncIterator, Awaitable
 from enum import Enum
+from functools import cached_property
 
+import orjson
 from dotenv import load_dotenv
-from pydantic import BaseModel, Field, field_validator, validator
-from openai import OpenAI
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator
+import httpx
+from openai import (
+    OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient,
+    RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+)
 from langgraph.graph import StateGraph, END
 from langgraph.checkpoint.memory import MemorySaver
 
@@ -29,6 +41,10 @@ from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from google.auth.transport.requests import Request
 from googleapiclient.errors import HttpError
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
+
+from llm_cache import LLMCache, MemoryCacheBackend, FileCacheBackend
 
 # =====================================================
 # CONFIGURATION & LOGGING
@@ -39,11 +55,19 @@ load_dotenv()
 Path("logs").mkdir(exist_ok=True)
 
 # Setup logging
+# The log file is rotated and written through a buffer (flushed every 1024 records,
+# on ERROR and at exit) instead of flushing on every record. DEBUG is opt-in via LOG_LEVEL.
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+_file_handler = logging.handlers.RotatingFileHandler(
+    'logs/fms_agent.log', maxBytes=5_000_000, backupCount=3, encoding='utf-8'
+)
+_file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
 logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format=LOG_FORMAT,
     handlers=[
-        logging.FileHandler('logs/fms_agent.log', encoding='utf-8'),
+        logging.handlers.MemoryHandler(capacity=1024, target=_file_handler),
         logging.StreamHandler()
     ]
 )
@@ -63,12 +87,25 @@ class Config:
     OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
     MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))
+    RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "1.0"))
+    RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "20.0"))
+    LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "5"))  # Max in-flight async LLM requests per process
+    HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+    HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
     PROJECT_BASE_DIR = Path(os.getenv("PROJECT_BASE_DIR", "projects"))
+    GOOGLE_HTTP_TIMEOUT = float(os.getenv("GOOGLE_HTTP_TIMEOUT", "30"))
     
-    SCOPES = [
+    # LLM response cache (used for temperature-0 calls): memory | file | off
+    # "file" also memoizes formula plans per formula prompt under LLM_CACHE_DIR/formula_plans
+    LLM_CACHE = os.getenv("LLM_CACHE", "memory").lower()
+    LLM_CACHE_DIR = Path(os.getenv("LLM_CACHE_DIR", ".cache/llm"))
+    LLM_SEMANTIC_CACHE_THRESHOLD = float(os.getenv("LLM_SEMANTIC_CACHE_THRESHOLD", "0.92"))
+    EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+    
+    SCOPES = (
         "https://www.googleapis.com/auth/drive",
         "https://www.googleapis.com/auth/spreadsheets"
-    ]
+    )
 
 class ColumnType(str, Enum):
     """Supported column types"""
@@ -82,8 +119,8 @@ class ColumnType(str, Enum):
     EMAIL = "email"
     URL = "url"
 
-# Stage color palette
-STAGE_COLORS = [
+# Stage color palette (shared by reference in formatting requests - never mutate)
+STAGE_COLORS = (
     {"red": 0.9, "green": 0.85, "blue": 0.85},  # Light red
     {"red": 0.85, "green": 0.9, "blue": 0.85},  # Light green
     {"red": 0.85, "green": 0.85, "blue": 0.9},  # Light blue
@@ -92,7 +129,40 @@ STAGE_COLORS = [
     {"red": 0.85, "green": 0.95, "blue": 0.9},  # Light cyan
     {"red": 0.95, "green": 0.85, "blue": 0.8},  # Light orange
     {"red": 0.9, "green": 0.9, "blue": 0.85},   # Light beige
-]
+)
+
+# Shared cell formats for the stage header rows (stage cells add their backgroundColor)
+_BLACK = {"red": 0, "green": 0, "blue": 0}
+STAGE_CELL_FORMAT = {
+    "textFormat": {"bold": True, "fontSize": 10},
+    "horizontalAlignment": "CENTER",
+    "verticalAlignment": "MIDDLE",
+    "borders": {
+        side: {"style": "SOLID", "width": 1, "color": _BLACK}
+        for side in ("bottom", "left", "right", "top")
+    }
+}
+HEADER_ROW_FORMAT = {
+    "backgroundColor": {"red": 0.95, "green": 0.95, "blue": 0.95},
+    "textFormat": {"bold": True, "fontSize": 10},
+    "horizontalAlignment": "CENTER",
+    "verticalAlignment": "MIDDLE",
+    "wrapStrategy": "WRAP",
+    "borders": {
+        "bottom": {"style": "SOLID", "width": 1, "color": _BLACK}
+    }
+}
+
+# Precompiled patterns used on every name / formula
+UNSAFE_NAME_CHARS_RE = re.compile(r'[^\w\s-]')
+NAME_SEPARATOR_RE = re.compile(r'[-\s]+')
+COLUMN_REF_RE = re.compile(r'\[\[(.*?)\]\]')
+# Tokens that affect bracket depth: escape sequences, quotes and brackets (matched in C)
+JSON_STRUCTURE_RE = re.compile(r'\\.|["{}\[\]]', re.DOTALL)
+# Opening ```lang line of a markdown code block
+MARKDOWN_FENCE_RE = re.compile(r'\s*```[^\n]*\n')
+# A complete "system_name" string value in a partial JSON response
+SYSTEM_NAME_RE = re.compile(r'"system_name"\s*:\s*"((?:[^"\\]|\\.)*)"')
 
 # =====================================================
 # ENHANCED SCHEMAS WITH STAGE SUPPORT
@@ -109,10 +179,10 @@ class WorkflowStage(BaseModel):
     
     @field_validator('stage_name')
     @classmethod
-    def validate_stage_name(cls, v):
-        if not v or len(v.strip()) == 0:
+    def validate_stage_name(cls, v: str) -> str:
+        if not v.strip():
             raise ValueError("Stage name cannot be empty")
-        return re.sub(r'[^\w\s-]', '', v).strip()
+        return UNSAFE_NAME_CHARS_RE.sub('', v).strip()
 
 class ColumnInfo(BaseModel):
     """Enhanced column information with stage awareness"""
@@ -129,17 +199,18 @@ class ColumnInfo(BaseModel):
     
     @field_validator('default_value', mode='before')
     @classmethod
-    def convert_default_value(cls, v):
-        if v is None:
+    def convert_default_value(cls, v: Any) -> Optional[str]:
+        # LLMs often emit numeric/boolean defaults; bool rules out coerce_numbers_to_str
+        if v is None or isinstance(v, str):
             return v
         return str(v)
     
     @field_validator('name')
     @classmethod
-    def validate_name(cls, v):
-        if not v or len(v.strip()) == 0:
+    def validate_name(cls, v: str) -> str:
+        if not v.strip():
             raise ValueError("Column name cannot be empty")
-        return re.sub(r'[^\w\s-]', '', v).strip()
+        return UNSAFE_NAME_CHARS_RE.sub('', v).strip()
 
 class SheetSchema(BaseModel):
     """Enhanced sheet schema with workflow stages"""
@@ -153,19 +224,36 @@ class SheetSchema(BaseModel):
     
     @field_validator('name')
     @classmethod
-    def validate_name(cls, v):
-        if not v or len(v.strip()) == 0:
+    def validate_name(cls, v: str) -> str:
+        if not v.strip():
             raise ValueError("Sheet name cannot be empty")
-        return re.sub(r'[^\w\s-]', '', v)[:100]
+        return UNSAFE_NAME_CHARS_RE.sub('', v)[:100]
     
-    def get_column_names(self) -> List[str]:
-        return [col.name for col in self.columns]
+    # Column lookups are built once per sheet (columns are not mutated after validation)
+    @cached_property
+    def column_names(self) -> Tuple[str, ...]:
+        return tuple(col.name for col in self.columns)
     
-    def get_column_by_name(self, name: str) -> Optional[ColumnInfo]:
+    @cached_property
+    def column_positions(self) -> Dict[str, int]:
+        """Column name -> 0-based index (first occurrence wins)"""
+        positions = {}
+        for i, name in enumerate(self.column_names):
+            positions.setdefault(name, i)
+        return positions
+    
+    @cached_property
+    def columns_by_name(self) -> Dict[str, ColumnInfo]:
+        by_name = {}
         for col in self.columns:
-            if col.name == name:
-                return col
-        return None
+            by_name.setdefault(col.name, col)
+        return by_name
+    
+    def get_column_names(self) -> Tuple[str, ...]:
+        return self.column_names
+    
+    def get_column_by_name(self, name: str) -> Optional[ColumnInfo]:
+        return self.columns_by_name.get(name)
 
 class FlowSchema(BaseModel):
     """Complete flow management system schema with stages"""
@@ -179,10 +267,21 @@ class FlowSchema(BaseModel):
     
     @field_validator('system_name')
     @classmethod
-    def validate_system_name(cls, v):
-        if not v or len(v.strip()) == 0:
+    def validate_system_name(cls, v: str) -> str:
+        if not v.strip():
             raise ValueError("System name cannot be empty")
         return v.strip()
+    
+    # Built once per flow (sheets are not mutated after validation)
+    @cached_property
+    def sheets_by_name(self) -> Dict[str, SheetSchema]:
+        by_name = {}
+        for sheet in self.sheets:
+            by_name.setdefault(sheet.name, sheet)
+        return by_name
+    
+    def get_sheet(self, name: str) -> Optional[SheetSchema]:
+        return self.sheets_by_name.get(name)
 
 class FormulaRule(BaseModel):
     """Enhanced formula rule with stage support"""
@@ -203,9 +302,29 @@ class FormulaPlan(BaseModel):
     validation_rules: Optional[List[Dict[str, Any]]] = Field(default_factory=list)
     conditional_formatting: Optional[List[Dict[str, Any]]] = Field(default_factory=list)
 
+def schema_response_format(model: Type[BaseModel]) -> Dict:
+    """
+    OpenAI json_schema response_format for a schema model.
+    Non-strict: strict mode rejects defaults and free-form Dict fields used by these schemas.
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": model.__name__,
+            "schema": model.model_json_schema(),
+            "strict": False
+        }
+    }
+
+FLOW_RESPONSE_FORMAT = schema_response_format(FlowSchema)
+FORMULA_RESPONSE_FORMAT = schema_response_format(FormulaPlan)
+
 # =====================================================
 # OPENAI CLIENT
 # =====================================================
+# Errors worth retrying; anything else (bad request, auth, ...) fails immediately
+TRANSIENT_LLM_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
 class LLMClient:
     """Enhanced OpenAI client"""
     
@@ -213,48 +332,208 @@ class LLMClient:
         if not Config.OPENAI_API_KEY:
             raise ValueError("OPENAI_API_KEY not found in environment variables")
         
-        self.client = OpenAI(api_key=Config.OPENAI_API_KEY)
+        # One keep-alive connection pool per client, shared by every agent (the client is a module global).
+        # HTTP/2 multiplexes concurrent requests over one TLS connection to api.openai.com.
+        # SDK retries are disabled so the backoff below is the only retry layer.
+        limits = httpx.Limits(
+            max_connections=Config.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=Config.HTTP_MAX_KEEPALIVE
+        )
+        self.client = OpenAI(
+            api_key=Config.OPENAI_API_KEY,
+            max_retries=0,
+            http_client=DefaultHttpxClient(limits=limits, http2=True)
+        )
+        self.async_client = AsyncOpenAI(
+            api_key=Config.OPENAI_API_KEY,
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(limits=limits, http2=True)
+        )
+        # Caps concurrent async requests across all workflows so fan-out stays under rate limits
+        self._semaphore = asyncio.Semaphore(Config.LLM_CONCURRENCY)
         self.model = Config.OPENAI_MODEL
+        self.max_retries = Config.MAX_RETRIES
+        self.cache = self._build_cache()
         logger.info(f"Initialized OpenAI client with model: {self.model}")
     
-    def invoke(self, prompt: str, system_prompt: Optional[str] = None, 
-               response_format: Optional[Dict] = None) -> str:
-        """Invoke OpenAI with retry logic"""
+    def _build_cache(self) -> Optional[LLMCache]:
+        """Create the response cache configured via LLM_CACHE"""
+        if Config.LLM_CACHE == "off":
+            return None
+        
+        if Config.LLM_CACHE == "file":
+            backend = FileCacheBackend(Config.LLM_CACHE_DIR)
+        else:
+            backend = MemoryCacheBackend()
+        
+        return LLMCache(
+            backend,
+            embed=self._aembed,
+            semantic_threshold=Config.LLM_SEMANTIC_CACHE_THRESHOLD
+        )
+    
+    async def _aembed(self, text: str) -> List[float]:
+        """Embedding used for semantic cache lookups"""
+        response = await self.async_client.embeddings.create(model=Config.EMBEDDING_MODEL, input=text)
+        return response.data[0].embedding
+    
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, min(Config.RETRY_MAX_DELAY, Config.RETRY_BASE_DELAY * 2 ** attempt))
+    
+    @classmethod
+    def _retry_delay(cls, attempt: int, error: Exception) -> float:
+        """Honor the server's Retry-After on rate limits, otherwise back off with jitter"""
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = response.headers.get("retry-after")
+            try:
+                return min(Config.RETRY_MAX_DELAY, float(retry_after))
+            except (TypeError, ValueError):
+                pass
+        return cls._backoff(attempt)
+    
+    @staticmethod
+    def _build_messages(prompt: str, system_prompt: Optional[str] = None) -> List[Dict]:
+        """Build the chat message list"""
         messages = []
         
         if system_prompt:
             messages.append({"role": "system", "content": system_prompt})
         
         messages.append({"role": "user", "content": prompt})
+        return messages
+    
+    def invoke(self, prompt: str, system_prompt: Optional[str] = None, 
+               response_format: Optional[Dict] = None) -> str:
+        """Invoke OpenAI with retry logic"""
+        # Request arguments don't change between attempts
+        kwargs = {
+            "model": self.model,
+            "messages": self._build_messages(prompt, system_prompt),
+        }
         
-        for attempt in range(Config.MAX_RETRIES):
+        if response_format:
+            kwargs["response_format"] = response_format
+        
+        for attempt in range(self.max_retries):
             try:
-                logger.debug(f"LLM invocation attempt {attempt + 1}/{Config.MAX_RETRIES}")
+                logger.debug("LLM invocation attempt %d/%d", attempt + 1, self.max_retries)
                 
-                kwargs = {
-                    "model": self.model,
-                    "messages": messages,
-                }
+                response = self.client.chat.completions.create(**kwargs)
+                content = response.choices[0].message.content
                 
-                if response_format:
-                    kwargs["response_format"] = response_format
+                logger.debug("LLM response received: %d characters", len(content))
+                return content
                 
-                response = self.client.chat.completions.create(**kwargs)
+            except TRANSIENT_LLM_ERRORS as e:
+                logger.error(f"LLM invocation failed (attempt {attempt + 1}): {str(e)}")
+                if attempt == self.max_retries - 1:
+                    raise
+                time.sleep(self._retry_delay(attempt, e))
+        
+        raise Exception("Max retries exceeded for LLM invocation")
+    
+    async def ainvoke(self, prompt: str, system_prompt: Optional[str] = None,
+                      response_format: Optional[Dict] = None,
+                      model: Optional[str] = None,
+                      temperature: Optional[float] = None,
+                      semantic_text: Optional[str] = None) -> str:
+        """
+        Async variant of invoke() - awaits the network call instead of blocking the event loop.
+        
+        Deterministic (temperature 0) calls are served from the response cache when possible;
+        semantic_text additionally lets near-duplicate requests reuse a cached response.
+        """
+        model = model or self.model
+        
+        if self.cache is None or temperature != 0:
+            return await self._ainvoke(prompt, system_prompt, response_format, model, temperature)
+        
+        payload = {
+            "model": model,
+            "temperature": temperature,
+            "system": system_prompt,
+            "user": prompt,
+            "response_format": response_format,
+        }
+        return await self.cache.get_or_call(
+            payload,
+            lambda: self._ainvoke(prompt, system_prompt, response_format, model, temperature),
+            semantic_text=semantic_text
+        )
+    
+    async def _ainvoke(self, prompt: str, system_prompt: Optional[str],
+                       response_format: Optional[Dict], model: str,
+                       temperature: Optional[float]) -> str:
+        """Uncached async OpenAI call with retry logic"""
+        # Request arguments don't change between attempts
+        kwargs = {
+            "model": model,
+            "messages": self._build_messages(prompt, system_prompt),
+        }
+        
+        if temperature is not None:
+            kwargs["temperature"] = temperature
+        
+        if response_format:
+            kwargs["response_format"] = response_format
+        
+        for attempt in range(self.max_retries):
+            try:
+                logger.debug("Async LLM invocation attempt %d/%d", attempt + 1, self.max_retries)
+                
+                async with self._semaphore:
+                    response = await self.async_client.chat.completions.create(**kwargs)
                 content = response.choices[0].message.content
                 
-                logger.debug(f"LLM response received: {len(content)} characters")
+                logger.debug("LLM response received: %d characters", len(content))
                 return content
                 
-            except Exception as e:
+            except TRANSIENT_LLM_ERRORS as e:
                 logger.error(f"LLM invocation failed (attempt {attempt + 1}): {str(e)}")
-                if attempt == Config.MAX_RETRIES - 1:
+                if attempt == self.max_retries - 1:
                     raise
-                continue
+                await asyncio.sleep(self._retry_delay(attempt, e))
         
         raise Exception("Max retries exceeded for LLM invocation")
+    
+    async def astream(self, prompt: str, system_prompt: Optional[str] = None,
+                      response_format: Optional[Dict] = None,
+                      model: Optional[str] = None,
+                      temperature: Optional[float] = None) -> AsyncIterator[str]:
+        """Stream the completion text as it is generated (uncached, not retried)"""
+        kwargs = {
+            "model": model or self.model,
+            "messages": self._build_messages(prompt, system_prompt),
+            "stream": True,
+            # The final chunk then carries token usage (with no choices)
+            "stream_options": {"include_usage": True},
+        }
+        
+        if temperature is not None:
+            kwargs["temperature"] = temperature
+        
+        if response_format:
+            kwargs["response_format"] = response_format
+        
+        async with self._semaphore:
+            stream = await self.async_client.chat.completions.create(**kwargs)
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                elif chunk.usage:
+                    logger.debug("LLM stream usage: %d prompt / %d completion tokens",
+                                 chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
 
-# Initialize global LLM client
-llm = LLMClient()
+@functools.lru_cache(maxsize=1)
+def get_llm() -> LLMClient:
+    """
+    Shared LLM client, created on first use so importing this module (e.g. for the
+    schemas) doesn't build the OpenAI clients, and CLI overrides of Config apply.
+    """
+    return LLMClient()
 
 # =====================================================
 # GOOGLE SERVICES
@@ -267,29 +546,36 @@ class GoogleServicesManager:
         self.drive = None
         self.sheets = None
     
+    @staticmethod
+    def _find_client_secrets() -> Path:
+        """Locate the OAuth client secrets file in the root or backend folder"""
+        search_paths = [Path("."), Path("backend")]
+        for path in search_paths:
+            # scandir stops at the first match without building a Path per entry
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if (entry.name.startswith("client_secret") and entry.name.endswith(".json")
+                                and entry.is_file()):
+                            return Path(entry.path)
+            except FileNotFoundError:
+                continue
+        
+        raise FileNotFoundError(
+            f"Google OAuth credentials file not found in {search_paths}. "
+            "Please download it from Google Cloud Console and place it in the project root or backend folder."
+        )
+    
     def authenticate(self) -> tuple:
-        """Authenticate and return Google services"""
+        """Authenticate and return Google services (a no-op once credentials are valid)"""
+        if self.creds and self.creds.valid and self.drive and self.sheets:
+            return self.drive, self.sheets
+        
         logger.info("Authenticating with Google services...")
         
         token_path = Path("token.json")
-        credentials_path = None
         
-        # Look for credentials file in root or backend folder
-        search_paths = [Path("."), Path("backend")]
-        for path in search_paths:
-            for file in path.glob("client_secret*.json"):
-                credentials_path = file
-                break
-            if credentials_path:
-                break
-        
-        if not credentials_path:
-            raise FileNotFoundError(
-                f"Google OAuth credentials file not found in {search_paths}. "
-                "Please download it from Google Cloud Console and place it in the project root or backend folder."
-            )
-        
-        if token_path.exists():
+        if not self.creds and token_path.exists():
             self.creds = Credentials.from_authorized_user_file(str(token_path), Config.SCOPES)
         
         if not self.creds or not self.creds.valid:
@@ -297,105 +583,210 @@ class GoogleServicesManager:
                 logger.info("Refreshing expired credentials...")
                 self.creds.refresh(Request())
             else:
+                # The client secrets file is only needed for the interactive flow
                 logger.info("Starting OAuth flow...")
                 flow = InstalledAppFlow.from_client_secrets_file(
-                    str(credentials_path), Config.SCOPES
+                    str(self._find_client_secrets()), Config.SCOPES
                 )
                 self.creds = flow.run_local_server(port=0)
             
-            token_path.write_text(self.creds.to_json())
+            atomic_write_bytes(token_path, self.creds.to_json().encode())
             logger.info("Credentials saved successfully")
         
-        self.drive = build("drive", "v3", credentials=self.creds)
-        self.sheets = build("sheets", "v4", credentials=self.creds)
+        self.drive, self.sheets = self.build_services()
         
         logger.info("Google services initialized successfully")
         return self.drive, self.sheets
+    
+    def _authorized_http(self) -> AuthorizedHttp:
+        """Credentialed transport with a request timeout (the httplib2 default waits forever)"""
+        return AuthorizedHttp(self.creds, http=httplib2.Http(timeout=Config.GOOGLE_HTTP_TIMEOUT))
+    
+    def build_services(self) -> tuple:
+        """
+        Build fresh Drive/Sheets clients from the authenticated credentials.
+        Uses the discovery documents bundled with googleapiclient (no HTTP fetch).
+        Each client owns one keep-alive httplib2 connection that every execute() reuses;
+        it is not thread-safe - build one set per worker.
+        """
+        drive = build("drive", "v3", http=self._authorized_http(),
+                      cache_discovery=False, static_discovery=True)
+        sheets = build("sheets", "v4", http=self._authorized_http(),
+                       cache_discovery=False, static_discovery=True)
+        return drive, sheets
 
 # =====================================================
 # UTILITY FUNCTIONS
 # =====================================================
+def atomic_write_bytes(path: Path, data: bytes) -> None:
+    """
+    Write a file in one go via a temp file + os.replace, so concurrent readers
+    (e.g. the projects API) never see a partially written file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
 class JSONCleaner:
     """Enhanced JSON cleaning from LLM responses"""
     
     @staticmethod
-    def clean(content: str) -> str:
-        """Clean and extract JSON from LLM response"""
-        content = content.strip()
-        
-        if content.startswith("```"):
-            first_newline = content.find("\n")
-            if first_newline != -1:
-                content = content[first_newline + 1:]
-            
-            closing_fence = content.rfind("```")
+    def extract(content: str) -> str:
+        """
+        Slice the JSON object/array out of an LLM response without parsing it.
+        Use this when the result goes straight to model_validate_json, which parses
+        and validates in a single pass.
+        """
+        # Work with indices into the original string; only the result is copied
+        start, end = 0, len(content)
+        while start < end and content[start].isspace():
+            start += 1
+        while end > start and content[end - 1].isspace():
+            end -= 1
+        
+        # Schema-constrained responses are usually bare JSON, so only look for a fence
+        # otherwise; the bracket scan below still runs so trailing text is cut off
+        fence = None if start < end and content[start] in "{[" else MARKDOWN_FENCE_RE.match(content)
+        if fence:
+            start = fence.end()
+            closing_fence = content.rfind("```", start)
             if closing_fence != -1:
-                content = content[:closing_fence]
-        
-        content = content.strip()
+                end = closing_fence
         
-        start_idx = content.find("{")
+        # Both response schemas are objects, so prefer the first "{" - an earlier "["
+        # is usually prose like "[1]"; fall back to an array only if there is no object
+        start_idx = content.find("{", start, end)
         if start_idx == -1:
-            start_idx = content.find("[")
+            start_idx = content.find("[", start, end)
             if start_idx == -1:
                 raise ValueError("No JSON object or array found in response")
         
-        open_char = content[start_idx]
-        close_char = "}" if open_char == "{" else "]"
-        count = 0
+        # Walk only the structural tokens, skipping brackets inside string values
+        depth = 0
+        in_string = False
         end_idx = -1
         
-        for i in range(start_idx, len(content)):
-            if content[i] == open_char:
-                count += 1
-            elif content[i] == close_char:
-                count -= 1
-                if count == 0:
-                    end_idx = i + 1
+        for match in JSON_STRUCTURE_RE.finditer(content, start_idx, end):
+            token = match.group()
+            if token[0] == "\\":
+                continue
+            if token == '"':
+                in_string = not in_string
+            elif in_string:
+                continue
+            elif token in "{[":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    end_idx = match.end()
                     break
         
         if end_idx == -1:
             raise ValueError("Malformed JSON: no matching closing bracket")
         
-        cleaned = content[start_idx:end_idx]
+        return content[start_idx:end_idx]
+    
+    @staticmethod
+    def clean(content: str) -> str:
+        """Clean and extract JSON from LLM response, checking that it parses"""
+        cleaned = JSONCleaner.extract(content)
         
         try:
-            json.loads(cleaned)
-        except json.JSONDecodeError as e:
+            orjson.loads(cleaned)
+        except orjson.JSONDecodeError as e:
             logger.error(f"JSON validation failed: {e}")
             raise ValueError(f"Invalid JSON structure: {e}")
         
         return cleaned
 
+PROJECT_SUBDIRS = ("schemas", "docs", "logs")
+
 class ProjectManager:
     """Manages project folder structure and files"""
     
     @staticmethod
-    def create_project_folder(prompt: str) -> Path:
-        """Create organized project folder structure"""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        sanitized = re.sub(r'[^\w\s-]', '', prompt)[:50]
-        sanitized = re.sub(r'[-\s]+', '_', sanitized).strip('_')
+    def create_project_folder(prompt: str, created_at: Optional[datetime] = None) -> Path:
+        """
+        Create organized project folder structure.
+        Pass the same created_at to save_metadata so the folder name and metadata agree.
+        """
+        timestamp = (created_at or datetime.now()).strftime("%Y%m%d_%H%M%S")
+        sanitized = UNSAFE_NAME_CHARS_RE.sub('', prompt)[:50]
+        sanitized = NAME_SEPARATOR_RE.sub('_', sanitized).strip('_')
         
         folder_name = f"{timestamp}_{sanitized}"
+        Config.PROJECT_BASE_DIR.mkdir(parents=True, exist_ok=True)
+        
+        # mkdir() without exist_ok claims the folder - concurrent runs (batch mode, the API) of the
+        # same prompt in the same second would otherwise share it and overwrite each other's files
         folder_path = Config.PROJECT_BASE_DIR / folder_name
+        suffix = 1
+        while True:
+            try:
+                folder_path.mkdir()
+                break
+            except FileExistsError:
+                suffix += 1
+                folder_path = Config.PROJECT_BASE_DIR / f"{folder_name}_{suffix}"
         
-        folder_path.mkdir(parents=True, exist_ok=True)
-        (folder_path / "schemas").mkdir(exist_ok=True)
-        (folder_path / "docs").mkdir(exist_ok=True)
-        (folder_path / "logs").mkdir(exist_ok=True)
+        for subdir in PROJECT_SUBDIRS:
+            (folder_path / subdir).mkdir(exist_ok=True)
         
         logger.info(f"Project folder created: {folder_path}")
         return folder_path
     
     @staticmethod
     def save_metadata(folder: Path, prompt: str, spreadsheet_id: str, 
-                     flow: FlowSchema, execution_time: float) -> Dict:
+                     flow: FlowSchema, execution_time: float,
+                     created_at: Optional[datetime] = None) -> Dict:
         """Save comprehensive project metadata"""
+        # One pass over the sheets builds the structure and the statistics together
+        sheets_out = []
+        total_columns = 0
+        total_stages = 0
+        sheets_with_relationships = 0
+        
+        for sheet in flow.sheets:
+            total_columns += len(sheet.columns)
+            total_stages += len(sheet.stages)
+            if sheet.relationships:
+                sheets_with_relationships += 1
+            
+            sheets_out.append({
+                "name": sheet.name,
+                "description": sheet.description,
+                "columns": [
+                    {
+                        "name": col.name,
+                        "type": col.type.value,
+                        "required": col.required,
+                        "description": col.description,
+                        "stage_number": col.stage_number
+                    }
+                    for col in sheet.columns
+                ],
+                "primary_key": sheet.primary_key,
+                "relationships": sheet.relationships,
+                "stages": [
+                    {
+                        "stage_number": stage.stage_number,
+                        "stage_name": stage.stage_name,
+                        "columns": stage.columns
+                    }
+                    for stage in sheet.stages
+                ]
+            })
+        
         metadata = {
             "project_info": {
                 "prompt": prompt,
-                "created_at": datetime.now().isoformat(),
+                "created_at": (created_at or datetime.now()).isoformat(),
                 "execution_time_seconds": round(execution_time, 2)
             },
             "spreadsheet": {
@@ -413,44 +804,17 @@ class ProjectManager:
                 "has_login_master": flow.has_login_master
             },
             "structure": {
-                "sheets": [
-                    {
-                        "name": sheet.name,
-                        "description": sheet.description,
-                        "columns": [
-                            {
-                                "name": col.name,
-                                "type": col.type.value,
-                                "required": col.required,
-                                "description": col.description,
-                                "stage_number": col.stage_number
-                            }
-                            for col in sheet.columns
-                        ],
-                        "primary_key": sheet.primary_key,
-                        "relationships": sheet.relationships,
-                        "stages": [
-                            {
-                                "stage_number": stage.stage_number,
-                                "stage_name": stage.stage_name,
-                                "columns": stage.columns
-                            }
-                            for stage in sheet.stages
-                        ]
-                    }
-                    for sheet in flow.sheets
-                ]
+                "sheets": sheets_out
             },
             "statistics": {
-                "total_columns": sum(len(sheet.columns) for sheet in flow.sheets),
-                "total_stages": sum(len(sheet.stages) for sheet in flow.sheets),
-                "sheets_with_relationships": len([s for s in flow.sheets if s.relationships])
+                "total_columns": total_columns,
+                "total_stages": total_stages,
+                "sheets_with_relationships": sheets_with_relationships
             }
         }
         
         metadata_path = folder / "metadata.json"
-        with open(metadata_path, "w", encoding="utf-8") as f:
-            json.dump(metadata, f, indent=2, ensure_ascii=False)
+        atomic_write_bytes(metadata_path, orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
         
         logger.info(f"Metadata saved to {metadata_path}")
         return metadata
@@ -460,28 +824,24 @@ class ProjectManager:
 # =====================================================
 class AgentState(BaseModel):
     """Enhanced agent state"""
+    # Nodes assign validated schemas to the state; no re-validation on assignment.
+    # Path and the schema models are all natively supported, so no arbitrary types are needed.
+    model_config = ConfigDict(validate_assignment=False, extra="ignore")
+    
     prompt: str
     project_folder: Optional[Path] = None
     flow: Optional[FlowSchema] = None
     formulas: Optional[FormulaPlan] = None
-    validation_rules: Optional[List[Dict]] = Field(default_factory=list)
+    validation_rules: List[Dict] = Field(default_factory=list)
     errors: List[str] = Field(default_factory=list)
     warnings: List[str] = Field(default_factory=list)
-    
-    class Config:
-        arbitrary_types_allowed = True
 
 # =====================================================
 # AGENT 1: STRUCTURE AGENT WITH STAGE SUPPORT
 # =====================================================
-def structure_agent(state: AgentState) -> Dict:
-    """Enhanced structure agent with workflow stage support"""
-    print("\n" + "="*70)
-    print("🏗️  STRUCTURE AGENT: Designing Workflow System with Stages")
-    print("="*70)
-    print(f"\n📝 User Requirement: {state.prompt}")
-    
-    system_prompt = """You are an expert business process architect specializing in workflow management systems.
+# Static prompt text is built once; only the INPUT section at the end varies per call,
+# so the same prefix is sent every time (provider-side prompt caching)
+STRUCTURE_SYSTEM_PROMPT = """You are an expert business process architect specializing in workflow management systems.
 Your role is to analyze business requirements and design comprehensive workflow systems.
 
 CRITICAL REQUIREMENTS:
@@ -514,10 +874,8 @@ Sheet Organization:
 - Login Master sheet for user authentication
 - Related stages grouped together visually
 """
-    
-    user_prompt = f"""Design a comprehensive Workflow Management System for:
 
-"{state.prompt}"
+STRUCTURE_USER_PROMPT = """Design a comprehensive Workflow Management System for the request given under INPUT below.
 
 Create a detailed system structure following these rules:
 
@@ -530,9 +888,9 @@ Create a detailed system structure following these rules:
    - MUST start with "Timestamp" column
    - Define workflow stages (e.g., Stage 1: LOI, Stage 2: Sanction, Stage 3: Foundation, etc.)
    - For each stage, include:
-     * Planned{{N}} column (date type) - MUST BE FIRST in stage
-     * Actual{{N}} column (date type) - MUST BE SECOND in stage
-     * Delay{{N}} column (formula type) - MUST BE THIRD in stage
+     * Planned{N} column (date type) - MUST BE FIRST in stage
+     * Actual{N} column (date type) - MUST BE SECOND in stage
+     * Delay{N} column (formula type) - MUST BE THIRD in stage
      * Stage-specific columns (data related to that stage) - Follows Delay
    - Group all columns for each stage together
    - Do NOT add "Stage Color" columns
@@ -547,21 +905,21 @@ Create a detailed system structure following these rules:
    - Columns: User Name, User ID, Pass, Role, Page Access, Status, Page Name
 
 Return ONLY valid JSON matching this structure:
-{{
+{
   "system_name": "Professional System Name",
   "description": "System description",
   "version": "1.0",
   "workflow_stages": ["Stage 1 Name", "Stage 2 Name", "Stage 3 Name"],
   "has_login_master": true,
   "sheets": [
-    {{
+    {
       "name": "Main Workflow Sheet Name",
       "description": "Main workflow tracking",
       "has_timestamp": true,
       "primary_key": "ID or Reg ID",
       "relationships": ["Related Sheet 1"],
       "stages": [
-        {{
+        {
           "stage_number": 1,
           "stage_name": "Stage 1 Name",
           "stage_description": "What this stage represents",
@@ -569,8 +927,8 @@ Return ONLY valid JSON matching this structure:
           "has_planned": true,
           "has_actual": true,
           "has_delay": true
-        }},
-        {{
+        },
+        {
           "stage_number": 2,
           "stage_name": "Stage 2 Name",
           "stage_description": "What this stage represents",
@@ -578,164 +936,228 @@ Return ONLY valid JSON matching this structure:
           "has_planned": true,
           "has_actual": true,
           "has_delay": true
-        }}
+        }
       ],
       "columns": [
-        {{
+        {
           "name": "Timestamp",
           "type": "date",
           "description": "Record creation timestamp",
           "required": true,
           "stage_number": null
-        }},
-        {{
+        },
+        {
           "name": "Serial No",
           "type": "number",
           "description": "Serial number",
           "required": true,
           "stage_number": null
-        }},
-        {{
+        },
+        {
           "name": "Reg ID",
           "type": "number",
           "description": "Registration ID",
           "required": true,
           "stage_number": null
-        }},
-        {{
+        },
+        {
           "name": "Column from Stage 1",
           "type": "text",
           "description": "Stage 1 specific column",
           "required": false,
           "stage_number": 1
-        }},
-        {{
+        },
+        {
           "name": "Planned1",
           "type": "date",
           "description": "Stage 1 planned completion date",
           "required": false,
           "stage_number": 1,
           "is_planned": true
-        }},
-        {{
+        },
+        {
           "name": "Actual1",
           "type": "date",
           "description": "Stage 1 actual completion date",
           "required": false,
           "stage_number": 1,
           "is_actual": true
-        }},
-        {{
+        },
+        {
           "name": "Delay1",
           "type": "formula",
           "description": "Stage 1 delay calculation",
           "required": false,
           "stage_number": 1,
           "is_delay": true
-        }}
+        }
       ]
-    }},
-    {{
+    },
+    {
       "name": "Login Master",
       "description": "User authentication and access control",
       "columns": [
-        {{"name": "User Name", "type": "text", "required": true}},
-        {{"name": "User ID", "type": "text", "required": true}},
-        {{"name": "Pass", "type": "text", "required": true}},
-        {{"name": "Role", "type": "text", "required": true}},
-        {{"name": "Page Access", "type": "text", "required": false}},
-        {{"name": "Status", "type": "text", "required": true}},
-        {{"name": "Page Name", "type": "text", "required": false}}
+        {"name": "User Name", "type": "text", "required": true},
+        {"name": "User ID", "type": "text", "required": true},
+        {"name": "Pass", "type": "text", "required": true},
+        {"name": "Role", "type": "text", "required": true},
+        {"name": "Page Access", "type": "text", "required": false},
+        {"name": "Status", "type": "text", "required": true},
+        {"name": "Page Name", "type": "text", "required": false}
       ]
-    }}
+    }
   ]
-}}
+}
 
 Design a professional, production-ready system!
+
+---
+INPUT:
 """
-    
-    try:
-        logger.info("Invoking LLM for structure generation...")
-        response = llm.invoke(user_prompt, system_prompt=system_prompt)
-        
-        cleaned_json = JSONCleaner.clean(response)
-        flow = FlowSchema.model_validate_json(cleaned_json)
-        logger.info(f"Flow schema validated: {flow.system_name}")
-        
-        # Save structure
-        if state.project_folder:
-            schema_file = state.project_folder / "schemas" / "flow_structure.json"
-            with open(schema_file, "w", encoding="utf-8") as f:
-                f.write(flow.model_dump_json(indent=2))
-            logger.info(f"Structure saved to {schema_file}")
-        
-        # Display summary
-        print("\n✅ System Structure Created Successfully!")
-        print(f"\n📊 System: {flow.system_name}")
-        print(f"📝 Description: {flow.description}")
-        
-        if flow.workflow_stages:
-            print(f"\n🔄 Workflow Stages ({len(flow.workflow_stages)}):")
-            for i, stage in enumerate(flow.workflow_stages, 1):
-                print(f"   {i}. {stage}")
-        
-        print(f"\n📋 Sheets ({len(flow.sheets)}):")
-        for i, sheet in enumerate(flow.sheets, 1):
-            print(f"\n   {i}. {sheet.name}")
-            if sheet.stages:
-                print(f"      Stages: {len(sheet.stages)}")
-                for stage in sheet.stages:
-                    print(f"        - Stage {stage.stage_number}: {stage.stage_name}")
-            print(f"      Total Columns: {len(sheet.columns)}")
-        
-        return {"flow": flow}
-        
-    except Exception as e:
-        error_msg = f"Structure generation failed: {str(e)}"
-        logger.error(error_msg, exc_info=True)
-        print(f"\n❌ Error: {error_msg}")
-        return {"errors": [error_msg]}
 
-# =====================================================
-# AGENT 2: FORMULA AGENT WITH STAGE FORMULAS
-# =====================================================
-def formula_agent(state: AgentState) -> Dict:
-    """Enhanced formula agent with stage-based formulas"""
+def _prepare_structure_call(state: AgentState) -> Tuple[str, str]:
+    """Print the agent banner and build (system_prompt, user_prompt)"""
     print("\n" + "="*70)
-    print("⚙️  FORMULA AGENT: Creating Stage Formulas")
+    print("🏗️  STRUCTURE AGENT: Designing Workflow System with Stages")
     print("="*70)
+    print(f"\n📝 User Requirement: {state.prompt}")
     
-    if not state.flow:
-        error_msg = "No flow structure available"
-        logger.error(error_msg)
-        return {"errors": [error_msg]}
-    
-    # Build sheet information
-    sheet_details = []
-    for sheet in state.flow.sheets:
-        cols_info = []
-        for col in sheet.columns:
-            stage_info = f" (Stage {col.stage_number})" if col.stage_number else ""
-            cols_info.append(f"    - {col.name} ({col.type.value}){stage_info}: {col.description or 'N/A'}")
-        
-        stage_info = ""
+    system_prompt = STRUCTURE_SYSTEM_PROMPT
+    user_prompt = STRUCTURE_USER_PROMPT + f'"{state.prompt}"\n'
+    return system_prompt, user_prompt
+
+def save_flow_structure(folder: Path, flow: FlowSchema) -> Path:
+    """Write schemas/flow_structure.json for a project"""
+    schema_file = folder / "schemas" / "flow_structure.json"
+    # Serialize straight to bytes (model_dump_json would decode to str only to re-encode)
+    atomic_write_bytes(schema_file, flow.__pydantic_serializer__.to_json(flow, indent=2))
+    logger.info(f"Structure saved to {schema_file}")
+    return schema_file
+
+def _finish_structure(state: AgentState, response: str, save: bool = True) -> Dict:
+    """Validate, save (unless save=False) and summarize the structure LLM response"""
+    # model_validate_json parses and validates in one pass - no separate JSON check
+    try:
+        flow = FlowSchema.model_validate_json(JSONCleaner.extract(response))
+    except ValidationError as e:
+        raise ValueError(f"Structure response is not a valid FlowSchema: {e}") from e
+    logger.info(f"Flow schema validated: {flow.system_name}")
+    
+    # Save structure
+    if save and state.project_folder:
+        save_flow_structure(state.project_folder, flow)
+    
+    # Display summary (collected and printed in one write)
+    lines = [
+        "\n✅ System Structure Created Successfully!",
+        f"\n📊 System: {flow.system_name}",
+        f"📝 Description: {flow.description}",
+    ]
+    
+    if flow.workflow_stages:
+        lines.append(f"\n🔄 Workflow Stages ({len(flow.workflow_stages)}):")
+        lines.extend(f"   {i}. {stage}" for i, stage in enumerate(flow.workflow_stages, 1))
+    
+    lines.append(f"\n📋 Sheets ({len(flow.sheets)}):")
+    for i, sheet in enumerate(flow.sheets, 1):
+        lines.append(f"\n   {i}. {sheet.name}")
         if sheet.stages:
-            stage_info = f"\nStages:\n"
+            lines.append(f"      Stages: {len(sheet.stages)}")
+        lines.append(f"      Total Columns: {len(sheet.columns)}")
+    
+    print("\n".join(lines))
+    
+    # Per-stage breakdown only with --verbose
+    if logger.isEnabledFor(logging.DEBUG):
+        for sheet in flow.sheets:
             for stage in sheet.stages:
-                stage_info += f"  Stage {stage.stage_number}: {stage.stage_name}\n"
+                logger.debug("%s - Stage %s: %s", sheet.name, stage.stage_number, stage.stage_name)
+    
+    return {"flow": flow}
+
+def _agent_error(stage: str, e: Exception) -> Dict:
+    """Log an agent failure and return it in the state-update format"""
+    error_msg = f"{stage} failed: {str(e)}"
+    logger.error(error_msg, exc_info=True)
+    print(f"\n❌ Error: {error_msg}")
+    return {"errors": [error_msg]}
+
+def structure_agent(state: AgentState) -> Dict:
+    """Enhanced structure agent with workflow stage support"""
+    system_prompt, user_prompt = _prepare_structure_call(state)
+    
+    try:
+        logger.info("Invoking LLM for structure generation...")
+        response = get_llm().invoke(user_prompt, system_prompt=system_prompt,
+                                    response_format=FLOW_RESPONSE_FORMAT)
+        return _finish_structure(state, response)
         
-        sheet_details.append(f"""
-Sheet: "{sheet.name}"
-Description: {sheet.description or 'N/A'}
-Has Timestamp: {sheet.has_timestamp}
-{stage_info}
-Columns:
-{chr(10).join(cols_info)}
-""")
+    except Exception as e:
+        return _agent_error("Structure generation", e)
+
+async def _astream_structure(user_prompt: str, system_prompt: str,
+                             model: Optional[str], temperature: Optional[float],
+                             on_system_name: Callable[[str], None]) -> str:
+    """Stream the structure response, reporting system_name as soon as it has been generated"""
+    chunks = []
+    head = ""
+    name_seen = False
+    
+    async for delta in get_llm().astream(user_prompt, system_prompt=system_prompt,
+                                         response_format=FLOW_RESPONSE_FORMAT,
+                                         model=model, temperature=temperature):
+        chunks.append(delta)
+        if not name_seen:
+            head += delta
+            match = SYSTEM_NAME_RE.search(head)
+            if match:
+                name_seen = True
+                on_system_name(orjson.loads(f'"{match.group(1)}"').strip())
+    
+    return "".join(chunks)
+
+async def astructure_agent(state: AgentState, model: Optional[str] = None,
+                           temperature: Optional[float] = None,
+                           on_system_name: Optional[Callable[[str], None]] = None,
+                           save: bool = True) -> Dict:
+    """
+    Async structure agent - same contract as structure_agent, without blocking the event loop.
+    
+    If on_system_name is given, the response is streamed and the callback receives the
+    system name as soon as it is generated, so dependent work can start early. It is not
+    called for cacheable (temperature 0) requests, which go through the response cache.
     
-    available_info = "\n".join(sheet_details)
+    With save=False the caller writes flow_structure.json itself (save_flow_structure),
+    e.g. concurrently with the formula call.
+    """
+    system_prompt, user_prompt = _prepare_structure_call(state)
     
-    system_prompt = """You are an expert in Google Sheets formulas.
+    try:
+        logger.info("Invoking LLM for structure generation...")
+        response = None
+        
+        if on_system_name and not (get_llm().cache is not None and temperature == 0):
+            try:
+                response = await _astream_structure(user_prompt, system_prompt, model,
+                                                    temperature, on_system_name)
+            except Exception as e:
+                logger.warning(f"Streaming structure generation failed, retrying without streaming: {e}")
+        
+        if response is None:
+            response = await get_llm().ainvoke(user_prompt, system_prompt=system_prompt,
+                                               response_format=FLOW_RESPONSE_FORMAT,
+                                               model=model, temperature=temperature,
+                                               semantic_text=state.prompt)
+        # Validation + file write run in a worker thread to keep the event loop free
+        return await asyncio.to_thread(_finish_structure, state, response, save)
+        
+    except Exception as e:
+        return _agent_error("Structure generation", e)
+
+# =====================================================
+# AGENT 2: FORMULA AGENT WITH STAGE FORMULAS
+# =====================================================
+FORMULA_SYSTEM_PROMPT = """You are an expert in Google Sheets formulas.
 
 CRITICAL FORMULA REQUIREMENTS:
 
@@ -759,16 +1181,13 @@ Google Sheets Syntax:
 - Conditional: IF(condition, true_value, false_value)
 - Row function: ROW(A6:A)
 """
-    
-    user_prompt = f"""Create formulas for this workflow system:
 
-SYSTEM STRUCTURE:
-{available_info}
+FORMULA_USER_PROMPT = """Create formulas for the workflow system whose structure is given under INPUT below.
 
 REQUIRED FORMULAS:
 
 1. For each Planned column (Planned1, Planned2, etc.):
-   - Use: =ARRAYFORMULA(IF(ROW(A6:A)=6, "ColumnName", {{A6:A}}))
+   - Use: =ARRAYFORMULA(IF(ROW(A6:A)=6, "ColumnName", {A6:A}))
    - Replace "ColumnName" with the actual target column name.
    - Reference Column A (Timestamp).
 
@@ -777,86 +1196,207 @@ REQUIRED FORMULAS:
    - Replace "ColumnName" with the actual target column name.
    - IMPORTANT: Do NOT use AND() function. It breaks ARRAYFORMULA. Use * to combine conditions.
 
-Return ONLY valid JSON:
-{{
-  "formulas": [
-    {{
-      "sheet": "Sheet Name",
-      "target_column": "Planned1",
-      "start_row": 6,
-      "formula": "=ARRAYFORMULA(IF(ROW(A6:A)=6, \\"Planned1\\", {{A6:A}}))",
-      "description": "Stage 1 planned calculated from timestamp",
-      "dependencies": ["Timestamp"],
-      "apply_to_all_rows": true,
-      "is_planned_formula": true,
-      "stage_number": 1
-    }},
-    {{
-      "sheet": "Sheet Name",
-      "target_column": "Delay1",
-      "start_row": 6,
-      "formula": "=ARRAYFORMULA(IF(ROW(A6:A)=6, \\"Delay1\\", IF(([[Actual1]]<>\\"\\")*([[Planned1]]<>\\"\\"), INT([[Actual1]]-[[Planned1]]), \\"\\")))",
-      "description": "Stage 1 delay calculation",
-      "dependencies": ["Planned1", "Actual1"],
-      "apply_to_all_rows": true,
-      "is_delay_formula": true,
-      "stage_number": 1
-    }}
-  ],
-  "validation_rules": [],
-  "conditional_formatting": []
-}}
+Return ONLY valid minified JSON (single line, no indentation or extra whitespace).
+Keep each "description" under 80 characters. Example:
+{"formulas":[{"sheet":"Sheet Name","target_column":"Planned1","start_row":6,"formula":"=ARRAYFORMULA(IF(ROW(A6:A)=6, \\"Planned1\\", {A6:A}))","description":"Stage 1 planned calculated from timestamp","dependencies":["Timestamp"],"apply_to_all_rows":true,"is_planned_formula":true,"stage_number":1},{"sheet":"Sheet Name","target_column":"Delay1","start_row":6,"formula":"=ARRAYFORMULA(IF(ROW(A6:A)=6, \\"Delay1\\", IF(([[Actual1]]<>\\"\\")*([[Planned1]]<>\\"\\"), INT([[Actual1]]-[[Planned1]]), \\"\\")))","description":"Stage 1 delay calculation","dependencies":["Planned1","Actual1"],"apply_to_all_rows":true,"is_delay_formula":true,"stage_number":1}],"validation_rules":[],"conditional_formatting":[]}
 
 Generate formulas for ALL stages! Reference all columns using [[ColumnName]] syntax.
-Use Row 6 for all formulas to include the header name (e.g., =ARRAYFORMULA(IF(ROW(A6:A)=6, "Name", {{A6:A}}))).
+Use Row 6 for all formulas to include the header name (e.g., =ARRAYFORMULA(IF(ROW(A6:A)=6, "Name", {A6:A}))).
+
+SCHEMA FORMAT (one line per sheet, columns in sheet order):
+SheetName|ts=Y or N (sheet has a Timestamp in column A)|stages=N:Stage Name;...|cols=ColumnName:type[@stage],...
+
+---
+INPUT:
+SYSTEM STRUCTURE:
 """
+
+def _compact_sheet_line(sheet: SheetSchema) -> str:
+    """
+    One-line sheet summary in the SCHEMA FORMAT of FORMULA_USER_PROMPT.
+    Descriptions are left out - they don't affect the formulas and cost input tokens.
+    """
+    stages = ";".join(f"{stage.stage_number}:{stage.stage_name}" for stage in sheet.stages)
+    cols = ",".join(
+        f"{col.name}:{col.type.value}@{col.stage_number}" if col.stage_number
+        else f"{col.name}:{col.type.value}"
+        for col in sheet.columns
+    )
+    return f"{sheet.name}|ts={'Y' if sheet.has_timestamp else 'N'}|stages={stages}|cols={cols}"
+
+def _prepare_formula_call(state: AgentState) -> Optional[Tuple[str, str]]:
+    """Print the agent banner and build (system_prompt, user_prompt); None if there is no flow"""
+    print("\n" + "="*70)
+    print("⚙️  FORMULA AGENT: Creating Stage Formulas")
+    print("="*70)
     
+    if not state.flow:
+        logger.error("No flow structure available")
+        return None
+    
+    available_info = "\n".join(map(_compact_sheet_line, state.flow.sheets))
+    
+    system_prompt = FORMULA_SYSTEM_PROMPT
+    user_prompt = FORMULA_USER_PROMPT + available_info + "\n"
+    return system_prompt, user_prompt
+
+def _formula_plan_cache_path(system_prompt: str, user_prompt: str, model: str) -> Optional[Path]:
+    """
+    Disk location of the memoized plan for this formula request (LLM_CACHE=file only).
+    Keyed on the model and the full prompt pair - the user prompt embeds the flow structure,
+    so any change to the structure or to either prompt template misses. Reused at any temperature.
+    """
+    if Config.LLM_CACHE != "file":
+        return None
+    key = LLMCache.make_key({
+        "model": model,
+        "system": system_prompt,
+        "user": user_prompt,
+    })
+    return Config.LLM_CACHE_DIR / "formula_plans" / f"{key}.json"
+
+def _read_cached_formula_plan(cache_path: Optional[Path]) -> Optional[str]:
+    """Cached plan JSON, or None on a miss"""
+    if cache_path is None:
+        return None
     try:
-        logger.info("Invoking LLM for formula generation...")
-        response = llm.invoke(user_prompt, system_prompt=system_prompt)
-        
-        cleaned_json = JSONCleaner.clean(response)
-        formulas = FormulaPlan.model_validate_json(cleaned_json)
-        logger.info(f"Formula plan validated: {len(formulas.formulas)} formulas")
-        
-        # Validate formulas
-        validated_formulas = []
-        for formula in formulas.formulas:
-            sheet = next((s for s in state.flow.sheets if s.name == formula.sheet), None)
-            if not sheet:
-                logger.warning(f"Skipping formula: Sheet '{formula.sheet}' not found")
-                continue
-            
-            if formula.target_column not in sheet.get_column_names():
-                logger.warning(f"Skipping formula: Column '{formula.target_column}' not found")
-                continue
-            
-            validated_formulas.append(formula)
+        return cache_path.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return None
+
+def _finish_formulas(state: AgentState, response: str, cache_path: Optional[Path] = None) -> Dict:
+    """Validate, save and summarize the formula LLM response"""
+    # model_validate_json parses and validates in one pass - no separate JSON check
+    try:
+        formulas = FormulaPlan.model_validate_json(JSONCleaner.extract(response))
+    except ValidationError as e:
+        raise ValueError(f"Formula response is not a valid FormulaPlan: {e}") from e
+    logger.info(f"Formula plan validated: {len(formulas.formulas)} formulas")
+    
+    # Validate formulas
+    validated_formulas = []
+    for formula in formulas.formulas:
+        sheet = state.flow.get_sheet(formula.sheet)
+        if not sheet:
+            logger.warning(f"Skipping formula: Sheet '{formula.sheet}' not found")
+            continue
+        
+        if formula.target_column not in sheet.column_positions:
+            logger.warning(f"Skipping formula: Column '{formula.target_column}' not found")
+            continue
+        
+        validated_formulas.append(formula)
+    
+    formulas.formulas = validated_formulas
+    plan_json = formulas.__pydantic_serializer__.to_json(formulas, indent=2)
+    
+    # Save formulas
+    if state.project_folder:
+        formula_file = state.project_folder / "schemas" / "formula_plan.json"
+        atomic_write_bytes(formula_file, plan_json)
+        logger.info(f"Formulas saved to {formula_file}")
+    
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_bytes(cache_path, plan_json)
+    
+    print(f"\n✅ Formula Plan Created: {len(formulas.formulas)} formulas")
+    
+    # Per-formula breakdown only with --verbose
+    if formulas.formulas and logger.isEnabledFor(logging.DEBUG):
+        for i, formula in enumerate(formulas.formulas, 1):
+            logger.debug("%d. %s | %s.%s | %.80s", i, formula.description,
+                         formula.sheet, formula.target_column, formula.formula)
+    
+    return {"formulas": formulas}
+
+def formula_agent(state: AgentState) -> Dict:
+    """Enhanced formula agent with stage-based formulas"""
+    prompts = _prepare_formula_call(state)
+    if prompts is None:
+        return {"errors": ["No flow structure available"]}
+    system_prompt, user_prompt = prompts
+    
+    try:
+        cache_path = _formula_plan_cache_path(system_prompt, user_prompt, get_llm().model)
+        cached = _read_cached_formula_plan(cache_path)
+        if cached is not None:
+            logger.info("Formula plan cache hit - skipping LLM call")
+            return _finish_formulas(state, cached)
         
-        formulas.formulas = validated_formulas
+        logger.info("Invoking LLM for formula generation...")
+        response = get_llm().invoke(user_prompt, system_prompt=system_prompt,
+                                    response_format=FORMULA_RESPONSE_FORMAT)
+        return _finish_formulas(state, response, cache_path)
         
-        # Save formulas
-        if state.project_folder:
-            formula_file = state.project_folder / "schemas" / "formula_plan.json"
-            with open(formula_file, "w", encoding="utf-8") as f:
-                f.write(formulas.model_dump_json(indent=2))
-            logger.info(f"Formulas saved to {formula_file}")
+    except Exception as e:
+        return _agent_error("Formula generation", e)
+
+# Every rule in a streamed formula plan carries exactly one "target_column" key
+FORMULA_RULE_KEY = '"target_column"'
+
+async def _astream_formulas(user_prompt: str, system_prompt: str,
+                            model: Optional[str], temperature: Optional[float],
+                            on_progress: Callable[[int], Awaitable[None]]) -> str:
+    """Stream the formula plan, reporting how many rules have been generated so far"""
+    chunks = []
+    tail = ""
+    count = 0
+    
+    async for delta in get_llm().astream(user_prompt, system_prompt=system_prompt,
+                                         response_format=FORMULA_RESPONSE_FORMAT,
+                                         model=model, temperature=temperature):
+        chunks.append(delta)
+        # Carry the end of the previous delta so a key split across chunks is still seen
+        window = tail + delta
+        found = window.count(FORMULA_RULE_KEY)
+        if found:
+            count += found
+            await on_progress(count)
+        tail = window[-(len(FORMULA_RULE_KEY) - 1):]
+    
+    return "".join(chunks)
+
+async def aformula_agent(state: AgentState, model: Optional[str] = None,
+                         temperature: Optional[float] = None,
+                         on_progress: Optional[Callable[[int], Awaitable[None]]] = None) -> Dict:
+    """
+    Async formula agent - same contract as formula_agent, without blocking the event loop.
+    
+    If on_progress is given, the response is streamed and the callback is awaited with the
+    number of formulas generated so far (not for cacheable temperature 0 requests).
+    """
+    prompts = _prepare_formula_call(state)
+    if prompts is None:
+        return {"errors": ["No flow structure available"]}
+    system_prompt, user_prompt = prompts
+    
+    try:
+        cache_path = _formula_plan_cache_path(system_prompt, user_prompt, model or get_llm().model)
+        cached = await asyncio.to_thread(_read_cached_formula_plan, cache_path)
+        if cached is not None:
+            logger.info("Formula plan cache hit - skipping LLM call")
+            return await asyncio.to_thread(_finish_formulas, state, cached)
         
-        print(f"\n✅ Formula Plan Created: {len(formulas.formulas)} formulas")
+        logger.info("Invoking LLM for formula generation...")
+        response = None
         
-        if formulas.formulas:
-            for i, formula in enumerate(formulas.formulas, 1):
-                print(f"\n   {i}. {formula.description}")
-                print(f"      Location: {formula.sheet}.{formula.target_column}")
-                print(f"      Formula: {formula.formula[:80]}...")
+        if on_progress and not (get_llm().cache is not None and temperature == 0):
+            try:
+                response = await _astream_formulas(user_prompt, system_prompt, model,
+                                                   temperature, on_progress)
+            except Exception as e:
+                logger.warning(f"Streaming formula generation failed, retrying without streaming: {e}")
         
-        return {"formulas": formulas}
+        if response is None:
+            response = await get_llm().ainvoke(user_prompt, system_prompt=system_prompt,
+                                               response_format=FORMULA_RESPONSE_FORMAT,
+                                               model=model, temperature=temperature)
+        # Validation + file write run in a worker thread to keep the event loop free
+        return await asyncio.to_thread(_finish_formulas, state, response, cache_path)
         
     except Exception as e:
-        error_msg = f"Formula generation failed: {str(e)}"
-        logger.error(error_msg, exc_info=True)
-        print(f"\n❌ Error: {error_msg}")
-        return {"errors": [error_msg]}
+        return _agent_error("Formula generation", e)
 
 # =====================================================
 # GOOGLE SHEETS OPERATIONS WITH STAGE FORMATTING
@@ -867,22 +1407,63 @@ class GoogleSheetsManager:
     def __init__(self, drive, sheets):
         self.drive = drive
         self.sheets = sheets
+        # spreadsheet_id -> {sheet title: sheetId}; kept in sync with our own structural changes
+        self._sheet_ids: Dict[str, Dict[str, int]] = {}
+    
+    def _get_sheet_ids(self, spreadsheet_id: str) -> Dict[str, int]:
+        """Sheet title -> sheetId, fetched once per spreadsheet"""
+        if spreadsheet_id not in self._sheet_ids:
+            spreadsheet = self.sheets.spreadsheets().get(
+                spreadsheetId=spreadsheet_id,
+                fields="sheets(properties(sheetId,title))"
+            ).execute(num_retries=Config.MAX_RETRIES)
+            self._sheet_ids[spreadsheet_id] = {
+                s['properties']['title']: s['properties']['sheetId']
+                for s in spreadsheet['sheets']
+            }
+        return self._sheet_ids[spreadsheet_id]
+    
+    @staticmethod
+    def _sheet_properties(sheet: SheetSchema, sheet_id: int) -> Dict:
+        """Sheet properties for a flow sheet with a client-assigned sheetId"""
+        return {
+            "sheetId": sheet_id,
+            "title": sheet.name,
+            "gridProperties": {
+                "rowCount": 1000,
+                "columnCount": len(sheet.columns) + 10
+            }
+        }
     
-    def create_spreadsheet(self, title: str) -> str:
-        """Create a new spreadsheet"""
+    def create_spreadsheet(self, title: str, flow: Optional[FlowSchema] = None) -> str:
+        """
+        Create a new spreadsheet.
+        If flow is given its sheets are created in the same call, and setup_sheets
+        then skips the add/delete-sheet step.
+        """
         try:
             logger.info(f"Creating spreadsheet: {title}")
             print(f"\n   📄 Creating spreadsheet: '{title}'...")
             
-            file = self.drive.files().create(
-                body={
-                    "name": title,
-                    "mimeType": "application/vnd.google-apps.spreadsheet"
-                },
-                fields="id"
+            body = {"properties": {"title": title}}
+            if flow:
+                body["sheets"] = [
+                    {"properties": self._sheet_properties(sheet, i)}
+                    for i, sheet in enumerate(flow.sheets, 1)
+                ]
+            
+            # Not retried - a retry after a lost response would create a second spreadsheet
+            spreadsheet = self.sheets.spreadsheets().create(
+                body=body,
+                fields="spreadsheetId,sheets.properties(sheetId,title)"
             ).execute()
             
-            spreadsheet_id = file["id"]
+            spreadsheet_id = spreadsheet["spreadsheetId"]
+            # The response already lists the sheets, so no follow-up get is needed
+            self._sheet_ids[spreadsheet_id] = {
+                s['properties']['title']: s['properties']['sheetId']
+                for s in spreadsheet['sheets']
+            }
             logger.info(f"Spreadsheet created: {spreadsheet_id}")
             print(f"   ✅ Spreadsheet created")
             
@@ -892,55 +1473,67 @@ class GoogleSheetsManager:
             logger.error(f"Failed to create spreadsheet: {e}")
             raise Exception(f"Spreadsheet creation failed: {e}")
     
+    def delete_spreadsheet(self, spreadsheet_id: str) -> None:
+        """Delete a spreadsheet (e.g. one created for a run that later failed)"""
+        self.drive.files().delete(fileId=spreadsheet_id).execute(num_retries=Config.MAX_RETRIES)
+        self._sheet_ids.pop(spreadsheet_id, None)
+        logger.info(f"Spreadsheet deleted: {spreadsheet_id}")
+    
     def setup_sheets(self, spreadsheet_id: str, flow: FlowSchema) -> None:
         """Create sheets with stage formatting"""
         try:
             logger.info(f"Setting up {len(flow.sheets)} sheets...")
             print(f"\n   📋 Creating {len(flow.sheets)} sheets...")
             
-            # Get default sheet to delete
-            spreadsheet = self.sheets.spreadsheets().get(
-                spreadsheetId=spreadsheet_id
-            ).execute()
-            default_sheet_id = spreadsheet['sheets'][0]['properties']['sheetId']
-            
+            sheet_ids = self._get_sheet_ids(spreadsheet_id)
+            default_title = None
             requests = []
             
-            # Create new sheets
+            if all(sheet.name in sheet_ids for sheet in flow.sheets):
+                # Already created along with the spreadsheet
+                new_ids = {sheet.name: sheet_ids[sheet.name] for sheet in flow.sheets}
+            else:
+                # Get default sheet to delete
+                default_title, default_sheet_id = next(iter(sheet_ids.items()))
+                
+                # New sheets get client-assigned ids so the formatting for them can go
+                # in the same batch that creates them
+                next_sheet_id = max(sheet_ids.values()) + 1
+                new_ids = {}
+                
+                # Create new sheets
+                for sheet in flow.sheets:
+                    new_ids[sheet.name] = next_sheet_id
+                    requests.append({
+                        "addSheet": {"properties": self._sheet_properties(sheet, next_sheet_id)}
+                    })
+                    next_sheet_id += 1
+                
+                # Delete default sheet (valid once the new sheets exist - requests apply in order)
+                requests.append({"deleteSheet": {"sheetId": default_sheet_id}})
+            
+            # Headers and formatting for all sheets
+            value_data = []
             for sheet in flow.sheets:
-                requests.append({
-                    "addSheet": {
-                        "properties": {
-                            "title": sheet.name,
-                            "gridProperties": {
-                                "rowCount": 1000,
-                                "columnCount": len(sheet.columns) + 10
-                            }
-                        }
-                    }
-                })
+                self._add_headers_with_stage_format(sheet, new_ids[sheet.name], value_data, requests)
             
-            # Execute
+            # One structural batch (sheets + formatting), then one values batch for headers
             self.sheets.spreadsheets().batchUpdate(
                 spreadsheetId=spreadsheet_id,
                 body={"requests": requests}
-            ).execute()
+            ).execute(num_retries=Config.MAX_RETRIES)
             
+            if default_title is not None:
+                sheet_ids.pop(default_title, None)
+            sheet_ids.update(new_ids)
             print("   ✅ All sheets created")
             
-            # Delete default sheet
-            try:
-                self.sheets.spreadsheets().batchUpdate(
-                    spreadsheetId=spreadsheet_id,
-                    body={"requests": [{"deleteSheet": {"sheetId": default_sheet_id}}]}
-                ).execute()
-            except:
-                pass
-            
-            # Add headers and formatting
             print("\n   🎨 Adding headers and stage formatting...")
-            for sheet in flow.sheets:
-                self._add_headers_with_stage_format(spreadsheet_id, sheet)
+            if value_data:
+                self.sheets.spreadsheets().values().batchUpdate(
+                    spreadsheetId=spreadsheet_id,
+                    body={"valueInputOption": "RAW", "data": value_data}
+                ).execute(num_retries=Config.MAX_RETRIES)
             
             print("   ✅ Formatting applied")
             
@@ -948,63 +1541,18 @@ class GoogleSheetsManager:
             logger.error(f"Failed to setup sheets: {e}")
             raise Exception(f"Sheet setup failed: {e}")
     
-    def _add_headers_with_stage_format(self, spreadsheet_id: str, sheet: SheetSchema) -> None:
-        """Add headers with stage names and colors (Rows 2 & 3) OR Standard (Row 1)"""
+    def _add_headers_with_stage_format(self, sheet: SheetSchema, sheet_id: int,
+                                       value_data: List[Dict], requests: List[Dict]) -> None:
+        """
+        Queue headers with stage names and colors (Rows 1-6) OR Standard (Row 1).
+        Appends value ranges to value_data and formatting requests to requests;
+        the caller sends them in one batch for all sheets.
+        """
         column_names = sheet.get_column_names()
         
         # Check if sheet has stages
         has_stages = bool(sheet.stages)
         
-        if has_stages:
-            # --- STAGE FORMAT (Rows 1-6) ---
-            # Row 1: Stage Names (Handled in _add_headers_with_stage_format)
-            # Row 2: System Name / Portal
-            # Row 3-5: Who/How/When labels
-            # Row 6: Column Headers
-            
-            # Write labels to Column A
-            label_values = [
-                [""], # Row 1 (Stage Names)
-                [""], # Row 2 (Empty)
-                ["Who"], # Row 3
-                ["How"], # Row 4
-                ["When"], # Row 5
-                column_names # Row 6 (Headers)
-            ]
-            
-            self.sheets.spreadsheets().values().update(
-                spreadsheetId=spreadsheet_id,
-                range=f"{sheet.name}!A1",
-                valueInputOption="RAW",
-                body={"values": label_values}
-            ).execute()
-        else:
-            # --- STANDARD FORMAT (Row 1) ---
-            # Add column headers (Row 1)
-            self.sheets.spreadsheets().values().update(
-                spreadsheetId=spreadsheet_id,
-                range=f"{sheet.name}!A1",
-                valueInputOption="RAW",
-                body={"values": [column_names]}
-            ).execute()
-
-        # Get sheet ID
-        spreadsheet = self.sheets.spreadsheets().get(
-            spreadsheetId=spreadsheet_id
-        ).execute()
-        
-        sheet_id = None
-        for s in spreadsheet['sheets']:
-            if s['properties']['title'] == sheet.name:
-                sheet_id = s['properties']['sheetId']
-                break
-        
-        if sheet_id is None:
-            return
-        
-        # Build formatting requests
-        requests = []
-        
         if has_stages:
             # 1. Standard format for Header Row (Row 3)
             requests.append({
@@ -1014,18 +1562,7 @@ class GoogleSheetsManager:
                         "startRowIndex": 5,
                         "endRowIndex": 6
                     },
-                    "cell": {
-                        "userEnteredFormat": {
-                            "backgroundColor": {"red": 0.95, "green": 0.95, "blue": 0.95},
-                            "textFormat": {"bold": True, "fontSize": 10},
-                            "horizontalAlignment": "CENTER",
-                            "verticalAlignment": "MIDDLE",
-                            "wrapStrategy": "WRAP",
-                            "borders": {
-                                 "bottom": {"style": "SOLID", "width": 1, "color": {"red": 0, "green": 0, "blue": 0}}
-                            }
-                        }
-                    },
+                    "cell": {"userEnteredFormat": HEADER_ROW_FORMAT},
                     "fields": "userEnteredFormat"
                 }
             })
@@ -1033,22 +1570,18 @@ class GoogleSheetsManager:
             # 2. Stage Name Logic
             stage_names_row = [""] * len(column_names)
             stage_ranges = {}
-            col_indices = {name: i for i, name in enumerate(column_names)}
+            col_indices = sheet.column_positions
+            
+            # Columns tagged with each stage_number, in one pass over the columns
+            numbered_indices = {}
+            for i, col in enumerate(sheet.columns):
+                if col.stage_number is not None:
+                    numbered_indices.setdefault(col.stage_number, []).append(i)
             
             for stage in sheet.stages:
-                indices = []
-                
-                # Check explicit columns list
-                for col_name in stage.columns:
-                     if col_name in col_indices:
-                         indices.append(col_indices[col_name])
-                
-                # Also check columns that have this stage_number
-                for col in sheet.columns:
-                    if col.stage_number == stage.stage_number:
-                        idx = col_indices.get(col.name)
-                        if idx is not None and idx not in indices:
-                            indices.append(idx)
+                # Explicit columns list plus the columns that have this stage_number
+                indices = {col_indices[col_name] for col_name in stage.columns if col_name in col_indices}
+                indices.update(numbered_indices.get(stage.stage_number, ()))
                 
                 if indices:
                     start_idx = min(indices)
@@ -1057,27 +1590,43 @@ class GoogleSheetsManager:
                     stage_ranges[stage.stage_number] = {
                         "start": start_idx, 
                         "end": end_idx,
-                        "name": stage.stage_name
+                        "name": stage.stage_name,
+                        # A span with gaps covers other stages' columns and must not be merged
+                        "contiguous": end_idx - start_idx + 1 == len(indices)
                     }
             
-            # Write Stage Names to Row 2
+            # --- STAGE FORMAT (Rows 1-6) ---
+            # Row 1: Stage Names
+            # Row 2: System Name / Portal
+            # Row 3-5: Who/How/When labels (Column A)
+            # Row 6: Column Headers
+            value_data.append({
+                "range": f"{sheet.name}!A1",
+                "values": [
+                    stage_names_row if any(stage_names_row) else [""],
+                    [""],
+                    ["Who"],
+                    ["How"],
+                    ["When"],
+                    column_names
+                ]
+            })
+            
             if any(stage_names_row):
-                self.sheets.spreadsheets().values().update(
-                    spreadsheetId=spreadsheet_id,
-                    range=f"{sheet.name}!A1",
-                    valueInputOption="RAW",
-                    body={"values": [stage_names_row]}
-                ).execute()
-                
                 # Format Stages
                 for stage_num, info in stage_ranges.items():
                     start = info["start"]
                     end = info["end"]
                     color_idx = (stage_num - 1) % len(STAGE_COLORS)
-                    color = STAGE_COLORS[color_idx]
+                    # One format dict per stage, shared by its Row 1 and Rows 3-6 requests
+                    stage_format = {**STAGE_CELL_FORMAT, "backgroundColor": STAGE_COLORS[color_idx]}
+                    
+                    if not info["contiguous"]:
+                        logger.warning("Stage %s columns in '%s' are not contiguous - not merging its header",
+                                       info["name"], sheet.name)
                     
                     # Merge Row 2
-                    if end > start:
+                    if end > start and info["contiguous"]:
                         requests.append({
                             "mergeCells": {
                                 "range": {
@@ -1101,20 +1650,7 @@ class GoogleSheetsManager:
                                 "startColumnIndex": start,
                                 "endColumnIndex": end + 1
                             },
-                            "cell": {
-                                "userEnteredFormat": {
-                                    "backgroundColor": color,
-                                    "textFormat": {"bold": True, "fontSize": 10},
-                                    "horizontalAlignment": "CENTER",
-                                    "verticalAlignment": "MIDDLE",
-                                    "borders": {
-                                        "bottom": {"style": "SOLID", "width": 1, "color": {"red": 0, "green": 0, "blue": 0}},
-                                        "left": {"style": "SOLID", "width": 1, "color": {"red": 0, "green": 0, "blue": 0}},
-                                        "right": {"style": "SOLID", "width": 1, "color": {"red": 0, "green": 0, "blue": 0}},
-                                        "top": {"style": "SOLID", "width": 1, "color": {"red": 0, "green": 0, "blue": 0}}
-                                    }
-                                }
-                            },
+                            "cell": {"userEnteredFormat": stage_format},
                             "fields": "userEnteredFormat"
                         }
                     })
@@ -1129,20 +1665,7 @@ class GoogleSheetsManager:
                                 "startColumnIndex": start,
                                 "endColumnIndex": end + 1
                             },
-                            "cell": {
-                                "userEnteredFormat": {
-                                    "backgroundColor": color,
-                                    "textFormat": {"bold": True, "fontSize": 10},
-                                    "horizontalAlignment": "CENTER",
-                                    "verticalAlignment": "MIDDLE",
-                                    "borders": {
-                                        "bottom": {"style": "SOLID", "width": 1, "color": {"red": 0, "green": 0, "blue": 0}},
-                                        "left": {"style": "SOLID", "width": 1, "color": {"red": 0, "green": 0, "blue": 0}},
-                                        "right": {"style": "SOLID", "width": 1, "color": {"red": 0, "green": 0, "blue": 0}},
-                                        "top": {"style": "SOLID", "width": 1, "color": {"red": 0, "green": 0, "blue": 0}}
-                                    }
-                                }
-                            },
+                            "cell": {"userEnteredFormat": stage_format},
                             "fields": "userEnteredFormat"
                         }
                     })
@@ -1237,7 +1760,11 @@ class GoogleSheetsManager:
             })
             
         else:
-            # --- STANDARD FORMATTING (No Stages) ---
+            # --- STANDARD FORMAT (Row 1) ---
+            value_data.append({
+                "range": f"{sheet.name}!A1",
+                "values": [column_names]
+            })
             
             # Format Header Row (Row 1)
             requests.append({
@@ -1274,14 +1801,7 @@ class GoogleSheetsManager:
                 }
             })
         
-        # Execute formatting
-        if requests:
-            self.sheets.spreadsheets().batchUpdate(
-                spreadsheetId=spreadsheet_id,
-                body={"requests": requests}
-            ).execute()
-        
-        logger.info(f"Headers and stage formatting applied for: {sheet.name}")
+        logger.info("Headers and stage formatting queued for: %s", sheet.name)
     
     def apply_formulas(self, spreadsheet_id: str, flow: FlowSchema, plan: FormulaPlan) -> None:
         """Apply formulas"""
@@ -1291,57 +1811,88 @@ class GoogleSheetsManager:
         
         print(f"\n   ⚙️  Applying {len(plan.formulas)} formulas...")
         
-        applied_count = 0
-        import re
-        
+        # Resolve every formula first, then write them all in one values batch;
+        # per-formula progress lines are printed together at the end
+        data = []
+        queued = []
+        report = []
         for formula in plan.formulas:
+            # Pre-pass: a formula whose target doesn't exist would otherwise land in column A
+            sheet = flow.get_sheet(formula.sheet)
+            if sheet is None or formula.target_column not in sheet.column_positions:
+                logger.warning("Skipping formula with unknown target: %s.%s", formula.sheet, formula.target_column)
+                report.append(f"   ⚠️  Skipped: {formula.description}")
+                continue
+            
             try:
-                # Post-process formula: Replace [[ColumnName]] with LetterRow:Letter
-                processed_formula = formula.formula
-                matches = re.findall(r'\[\[(.*?)\]\]', processed_formula)
+                # Post-process formula: Replace [[ColumnName]] with LetterRow:Letter in one pass
+                # (for ARRAYFORMULA starting at Row 6, we use Letter6:Letter)
+                processed_formula = COLUMN_REF_RE.sub(
+                    lambda m: self._column_range(sheet.column_positions, m.group(1)),
+                    formula.formula
+                )
                 
-                for col_name in matches:
-                    letter = self._get_column_letter(col_name, flow, formula.sheet)
-                    # For ARRAYFORMULA starting at Row 6, we use Letter6:Letter
-                    range_ref = f"{letter}6:{letter}"
-                    processed_formula = processed_formula.replace(f"[[{col_name}]]", range_ref)
+                if formula.apply_to_all_rows:
+                    processed_formula = self._as_array_formula(processed_formula)
                 
-                # Apply formula directly
-                range_notation = f"{formula.sheet}!{self._get_column_letter(formula.target_column, flow, formula.sheet)}{formula.start_row}"
+                target_letter = self._col_letter(sheet.column_positions[formula.target_column] + 1)
+                range_notation = f"{formula.sheet}!{target_letter}{formula.start_row}"
+                data.append({"range": range_notation, "values": [[processed_formula]]})
+                queued.append(formula)
                 
-                self.sheets.spreadsheets().values().update(
+            except Exception as e:
+                logger.warning("Failed to prepare formula: %s", e)
+                report.append(f"   ⚠️  Skipped: {formula.description}")
+        
+        applied_count = 0
+        if data:
+            try:
+                response = self.sheets.spreadsheets().values().batchUpdate(
                     spreadsheetId=spreadsheet_id,
-                    range=range_notation,
-                    valueInputOption="USER_ENTERED",
-                    body={"values": [[processed_formula]]}
-                ).execute()
-                
-                applied_count += 1
-                logger.info(f"Formula applied: {formula.sheet}.{formula.target_column}")
-                print(f"   ✅ {formula.description}")
+                    body={"valueInputOption": "USER_ENTERED", "data": data}
+                ).execute(num_retries=Config.MAX_RETRIES)
                 
-            except Exception as e:
-                logger.warning(f"Failed to apply formula: {e}")
-                print(f"   ⚠️  Skipped: {formula.description}")
+                # One response per value range, in request order
+                for formula, result in zip(queued, response.get("responses", [])):
+                    if result.get("updatedCells"):
+                        applied_count += 1
+                        logger.info("Formula applied: %s.%s", formula.sheet, formula.target_column)
+                        report.append(f"   ✅ {formula.description}")
+                    else:
+                        logger.warning("Formula not written: %s.%s", formula.sheet, formula.target_column)
+                        report.append(f"   ⚠️  Not written: {formula.description}")
+                    
+            except HttpError as e:
+                logger.warning("Failed to apply formulas: %s", e)
+                report.append(f"   ⚠️  Formula batch failed: {e}")
         
-        print(f"\n   ✅ Applied {applied_count}/{len(plan.formulas)} formulas")
+        report.append(f"\n   ✅ Applied {applied_count}/{len(plan.formulas)} formulas")
+        print("\n".join(report))
     
-    def _get_column_letter(self, col_name: str, flow: FlowSchema, sheet_name: str) -> str:
-        """Get column letter for a column name"""
-        sheet = next((s for s in flow.sheets if s.name == sheet_name), None)
-        if not sheet:
-            return "A"
-        
-        col_names = sheet.get_column_names()
-        try:
-            col_index = col_names.index(col_name)
-            return self._col_letter(col_index + 1)
-        except ValueError:
-            return "A"
+    @staticmethod
+    def _as_array_formula(formula: str) -> str:
+        """
+        Wrap a formula in ARRAYFORMULA(IFERROR(...)) so one cell fills the whole column
+        (Sheets evaluates it server-side instead of needing a write per row).
+        Formulas the model already wrote as ARRAYFORMULA are left alone.
+        """
+        body = formula.strip()
+        if body.startswith("="):
+            body = body[1:].lstrip()
+        if body.upper().startswith("ARRAYFORMULA"):
+            return formula
+        return f'=ARRAYFORMULA(IFERROR({body},""))'
+    
+    @classmethod
+    def _column_range(cls, positions: Dict[str, int], col_name: str) -> str:
+        """Open-ended data range (Letter6:Letter) for a column; unknown names map to column A"""
+        letter = cls._col_letter(positions.get(col_name, 0) + 1)
+        return f"{letter}6:{letter}"
     
     @staticmethod
+    @functools.lru_cache(maxsize=1024)
     def _col_letter(index: int) -> str:
-        """Convert column index to Excel letter"""
+        """Convert column index to Excel letter (memoized - called per column reference)"""
         result = ""
         while index:
             index, rem = divmod(index - 1, 26)
@@ -1364,16 +1915,118 @@ def build_workflow() -> StateGraph:
     
     return workflow.compile()
 
-def main():
-    """Main execution"""
+def generate_system(user_prompt: str, workflow, get_services: Callable[[], tuple]) -> Optional[str]:
+    """
+    Generate one system end to end: agents, spreadsheet and metadata.
+    get_services returns (drive, sheets) clients for this call.
+    Returns the spreadsheet id, or None if the agent workflow failed.
+    """
     start_time = datetime.now()
     
+    print("\n" + "="*70)
+    print("🚀 STARTING WORKFLOW SYSTEM GENERATION")
+    print("="*70)
+    print(f"\n📌 System: {user_prompt}")
+    print(f"🤖 Model: {Config.OPENAI_MODEL}")
+    
+    # Create project folder
+    project_folder = ProjectManager.create_project_folder(user_prompt, start_time)
+    print(f"📁 Project: {project_folder.name}")
+    
+    # Initialize state
+    initial_state = AgentState(
+        prompt=user_prompt,
+        project_folder=project_folder
+    )
+    
+    # Run workflow
+    print("\n" + "="*70)
+    print("🔄 EXECUTING WORKFLOW")
+    print("="*70)
+    
+    final_state = workflow.invoke(initial_state)
+    
+    if final_state.get("errors"):
+        print("\n❌ WORKFLOW FAILED")
+        for error in final_state["errors"]:
+            print(f"   {error}")
+        return None
+    
+    # Create spreadsheet
+    print("\n" + "="*70)
+    print("📊 CREATING GOOGLE SPREADSHEET")
+    print("="*70)
+    
+    drive, sheets = get_services()
+    
+    sheets_manager = GoogleSheetsManager(drive, sheets)
+    
+    # The graph hands back the agents' model instances; model_validate returns those as-is
+    flow = FlowSchema.model_validate(final_state["flow"])
+    spreadsheet_id = sheets_manager.create_spreadsheet(flow.system_name, flow)
+    
+    sheets_manager.setup_sheets(spreadsheet_id, flow)
+    
+    formulas = FormulaPlan.model_validate(final_state["formulas"])
+    sheets_manager.apply_formulas(spreadsheet_id, flow, formulas)
+    
+    end_time = datetime.now()
+    execution_time = (end_time - start_time).total_seconds()
+    
+    # Save metadata in the background - the spreadsheet link doesn't depend on it
+    metadata_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    metadata_future = metadata_executor.submit(
+        ProjectManager.save_metadata,
+        project_folder,
+        user_prompt,
+        spreadsheet_id,
+        flow,
+        execution_time,
+        start_time
+    )
+    metadata_executor.shutdown(wait=False)
+    
+    # Success message
+    print("\n" + "="*70)
+    print("✅ SYSTEM GENERATED SUCCESSFULLY!")
+    print("="*70)
+    
+    print(f"\n📊 System: {flow.system_name}")
+    print(f"⏱️  Time: {execution_time:.2f}s")
+    print(f"📋 Sheets: {len(flow.sheets)}")
+    print(f"🔄 Total Stages: {sum(len(s.stages) for s in flow.sheets)}")
+    
+    print("\n🔗 Spreadsheet:")
+    print(f"   https://docs.google.com/spreadsheets/d/{spreadsheet_id}/edit")
+    
+    print(f"\n📁 Project:")
+    print(f"   {project_folder.absolute()}")
+    
+    # Surface any failure writing the metadata before returning
+    metadata_future.result(timeout=30)
+    print("\n📄 Metadata saved")
+    
+    return spreadsheet_id
+
+def load_batch_prompts(path: Path) -> List[str]:
+    """Read a JSON list of prompt strings for --batch-file"""
+    prompts = orjson.loads(path.read_bytes())
+    if not isinstance(prompts, list) or not all(isinstance(p, str) and p.strip() for p in prompts):
+        raise ValueError(f"{path} must contain a JSON list of non-empty prompt strings")
+    return [p.strip() for p in prompts]
+
+def main():
+    """Main execution"""
     parser = argparse.ArgumentParser(
         description="🤖 Flow Management System - Enhanced Workflow Stages v3.0"
     )
     parser.add_argument("prompt", nargs="?", help="System description")
     parser.add_argument("--model", default=Config.OPENAI_MODEL, help="OpenAI model")
     parser.add_argument("--verbose", action="store_true", help="Verbose logging")
+    parser.add_argument("--batch-file", type=Path,
+                        help="JSON file with a list of prompts to generate in one run")
+    parser.add_argument("--batch-workers", type=int, default=2,
+                        help="Systems generated concurrently with --batch-file (keep low for Sheets quotas)")
     
     args = parser.parse_args()
     
@@ -1383,9 +2036,15 @@ def main():
     if args.model:
         Config.OPENAI_MODEL = args.model
     
-    # Get prompt
-    if args.prompt:
-        user_prompt = args.prompt
+    # Get prompt(s)
+    if args.batch_file:
+        try:
+            prompts = load_batch_prompts(args.batch_file)
+        except (OSError, ValueError) as e:
+            print(f"\n❌ Error: {e}")
+            return
+    elif args.prompt:
+        prompts = [args.prompt]
     else:
         print("\n" + "="*70)
         print("🤖 WORKFLOW MANAGEMENT SYSTEM - STAGE-BASED")
@@ -1397,89 +2056,47 @@ def main():
         if not user_prompt:
             print("\n❌ Error: Prompt cannot be empty")
             return
+        prompts = [user_prompt]
     
     try:
-        print("\n" + "="*70)
-        print("🚀 STARTING WORKFLOW SYSTEM GENERATION")
-        print("="*70)
-        print(f"\n📌 System: {user_prompt}")
-        print(f"🤖 Model: {Config.OPENAI_MODEL}")
-        
-        # Create project folder
-        project_folder = ProjectManager.create_project_folder(user_prompt)
-        print(f"📁 Project: {project_folder.name}")
-        
-        # Build workflow
+        # Build workflow once - the compiled graph is stateless and shared by every prompt
         workflow = build_workflow()
         
-        # Initialize state
-        initial_state = AgentState(
-            prompt=user_prompt,
-            project_folder=project_folder
-        )
-        
-        # Run workflow
-        print("\n" + "="*70)
-        print("🔄 EXECUTING WORKFLOW")
-        print("="*70)
-        
-        final_state = workflow.invoke(initial_state.dict())
-        
-        if final_state.get("errors"):
-            print("\n❌ WORKFLOW FAILED")
-            for error in final_state["errors"]:
-                print(f"   {error}")
-            return
-        
-        # Create spreadsheet
-        print("\n" + "="*70)
-        print("📊 CREATING GOOGLE SPREADSHEET")
-        print("="*70)
-        
+        # Authenticate in the background so the token refresh overlaps the LLM calls
         google_manager = GoogleServicesManager()
-        drive, sheets = google_manager.authenticate()
-        
-        sheets_manager = GoogleSheetsManager(drive, sheets)
-        
-        flow = final_state["flow"] if isinstance(final_state["flow"], FlowSchema) else FlowSchema(**final_state["flow"])
-        spreadsheet_id = sheets_manager.create_spreadsheet(flow.system_name)
-        
-        sheets_manager.setup_sheets(spreadsheet_id, flow)
-        
-        formulas = final_state["formulas"] if isinstance(final_state["formulas"], FormulaPlan) else FormulaPlan(**final_state["formulas"])
-        sheets_manager.apply_formulas(spreadsheet_id, flow, formulas)
+        auth_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        auth_future = auth_executor.submit(google_manager.authenticate)
+        auth_executor.shutdown(wait=False)
         
-        # Save metadata
-        end_time = datetime.now()
-        execution_time = (end_time - start_time).total_seconds()
-        
-        print("\n" + "="*70)
-        print("📄 SAVING METADATA")
-        print("="*70)
-        
-        metadata = ProjectManager.save_metadata(
-            project_folder,
-            user_prompt,
-            spreadsheet_id,
-            flow,
-            execution_time
-        )
-        
-        # Success message
-        print("\n" + "="*70)
-        print("✅ SYSTEM GENERATED SUCCESSFULLY!")
-        print("="*70)
-        
-        print(f"\n📊 System: {flow.system_name}")
-        print(f"⏱️  Time: {execution_time:.2f}s")
-        print(f"📋 Sheets: {len(flow.sheets)}")
-        print(f"🔄 Total Stages: {sum(len(s.stages) for s in flow.sheets)}")
-        
-        print("\n🔗 Spreadsheet:")
-        print(f"   {metadata['spreadsheet']['edit_url']}")
+        if len(prompts) == 1:
+            generate_system(prompts[0], workflow, auth_future.result)
+            return
         
-        print(f"\n📁 Project:")
-        print(f"   {project_folder.absolute()}")
+        # Build the shared LLM client here - lru_cache doesn't stop concurrent first calls
+        # from the workers each building their own client
+        get_llm()
+        
+        def worker_services() -> tuple:
+            # One OAuth session for the batch, but separate clients per worker (not thread-safe)
+            auth_future.result()
+            return google_manager.build_services()
+        
+        print(f"\n📚 Batch: {len(prompts)} systems, {args.batch_workers} at a time")
+        succeeded = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.batch_workers)) as pool:
+            futures = {
+                pool.submit(generate_system, prompt, workflow, worker_services): prompt
+                for prompt in prompts
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    if future.result():
+                        succeeded += 1
+                except Exception as e:
+                    print(f"\n❌ ERROR ({futures[future]}): {e}")
+                    logger.error(f"Batch item failed: {e}", exc_info=True)
+        
+        print(f"\n📚 Batch complete: {succeeded}/{len(prompts)} systems generated")
         
     except KeyboardInterrupt:
         print("\n\n⚠️  Cancelled")
@@ -4,6 +4,8 @@ const WS_URL = API_URL.replace('http', 'ws');
 
 let websocket = null;
 let isProcessing = false;
+let currentJobId = null;
+let pendingJobEvents = null;  // job-tagged events received while the create POST is in flight
 
 // DOM Elements
 const chatArea = document.getElementById('chatArea');
@@ -35,13 +37,7 @@ function connectWebSocket() {
         websocket.onopen = () => {
             console.log('WebSocket connected');
             updateStatus('connected', 'Connected');
-            
-            // Keep alive
-            setInterval(() => {
-                if (websocket.readyState === WebSocket.OPEN) {
-                    websocket.send('ping');
-                }
-            }, 30000);
+            // Keep-alive is handled by the server's protocol-level pings
         };
         
         websocket.onmessage = (event) => {
@@ -75,6 +71,13 @@ function updateStatus(status, text) {
 
 // Handle WebSocket messages
 function handleWebSocketMessage(data) {
+    if (data.job_id && data.job_id !== currentJobId) {
+        // Our job_id isn't known until the POST resolves; hold events until it is
+        if (pendingJobEvents) pendingJobEvents.push(data);
+        // Otherwise it belongs to another client's workflow
+        return;
+    }
+    
     switch (data.type) {
         case 'log':
             addLogEntry(data);
@@ -87,9 +90,6 @@ function handleWebSocketMessage(data) {
             addAgentMessage(data.message, null, 'error');
             setProcessing(false);
             break;
-        case 'pong':
-            // Keep alive response
-            break;
         default:
             console.log('Unknown message type:', data);
     }
@@ -144,6 +144,8 @@ async function createWorkflow() {
     
     // Clear previous logs
     clearLogs();
+    currentJobId = null;
+    pendingJobEvents = [];
     
     // Show logs panel
     if (logPanel.classList.contains('hidden')) {
@@ -173,9 +175,14 @@ async function createWorkflow() {
             throw new Error(result.message || 'Workflow creation failed');
         }
         
-        // WebSocket will handle the completion message
+        // Runs in the background; WebSocket will handle the completion message
+        currentJobId = result.job_id;
+        const buffered = pendingJobEvents;
+        pendingJobEvents = null;
+        buffered.forEach(handleWebSocketMessage);
         
     } catch (error) {
+        pendingJobEvents = null;
         console.error('Error creating workflow:', error);
         addAgentMessage(`❌ Error: ${error.message}`, null, 'error');
         setProcessing(false);
@@ -1,11 +1,13 @@
 import os
-import json
 import re
+import functools
+import logging
 import argparse
 from datetime import datetime
 from pathlib import Path
 from typing import List, TypedDict
 from dotenv import load_dotenv
+import orjson
 
 from pydantic import BaseModel
 
@@ -16,12 +18,16 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
 
 # =====================================================
 # ENV
 # =====================================================
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # =====================================================
 # LLM (GROQ + LLAMA)
 # =====================================================
@@ -38,7 +44,11 @@ SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets"
 ]
 
+GOOGLE_HTTP_TIMEOUT = 30  # seconds
+
+@functools.lru_cache(maxsize=1)
 def get_google_services():
+    """Authenticate once and return (drive, sheets) clients, memoized for the process."""
     creds = None
 
     if os.path.exists("token.json"):
@@ -57,8 +67,11 @@ def get_google_services():
         with open("token.json", "w") as f:
             f.write(creds.to_json())
 
-    drive = build("drive", "v3", credentials=creds)
-    sheets = build("sheets", "v4", credentials=creds)
+    # One authorized HTTP client (reused connections, bounded timeout) for both services;
+    # the bundled discovery documents are used instead of fetching them
+    http = AuthorizedHttp(creds, http=httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT))
+    drive = build("drive", "v3", http=http, cache_discovery=False, static_discovery=True)
+    sheets = build("sheets", "v4", http=http, cache_discovery=False, static_discovery=True)
 
     return drive, sheets
 
@@ -126,6 +139,14 @@ def strip_markdown_json(content: str) -> str:
     if start_idx == -1:
         return content
     
+    # Fast path: the JSON usually spans from the first { to the last }
+    candidate = content[start_idx:content.rfind("}") + 1]
+    try:
+        orjson.loads(candidate)
+        return candidate
+    except orjson.JSONDecodeError:
+        pass
+    
     # Count braces to find the matching closing brace
     brace_count = 0
     end_idx = -1
@@ -143,12 +164,15 @@ def strip_markdown_json(content: str) -> str:
     
     return content
 
+_SANITIZE_STRIP = re.compile(r'[^\w\s-]')
+_SANITIZE_UNDERSCORE = re.compile(r'[-\s]+')
+
 def create_project_folder(prompt: str) -> Path:
     """Create a project folder with timestamp and sanitized prompt name."""
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     # Sanitize prompt for folder name
-    sanitized = re.sub(r'[^\w\s-]', '', prompt)[:50]  # Max 50 chars
-    sanitized = re.sub(r'[-\s]+', '_', sanitized).strip('_')
+    sanitized = _SANITIZE_STRIP.sub('', prompt)[:50]  # Max 50 chars
+    sanitized = _SANITIZE_UNDERSCORE.sub('_', sanitized).strip('_')
     
     folder_name = f"{timestamp}_{sanitized}"
     folder_path = Path("projects") / folder_name
@@ -174,14 +198,13 @@ def save_metadata(folder: Path, prompt: str, spreadsheet_id: str, flow: FlowSche
         ]
     }
     
-    with open(folder / "metadata.json", "w", encoding="utf-8") as f:
-        json.dump(metadata, f, indent=2)
+    (folder / "metadata.json").write_bytes(orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
     
     return metadata
 
 def generate_documentation(folder: Path, prompt: str, flow: FlowSchema, formulas: FormulaPlan, spreadsheet_id: str):
     """Generate comprehensive documentation in markdown."""
-    doc = f"""# {flow.system_name}
+    parts: list[str] = [f"""# {flow.system_name}
 
 ## Project Information
 - **Prompt**: {prompt}
@@ -196,66 +219,73 @@ This system consists of {len(flow.sheets)} interconnected Google Sheets designed
 
 ### Sheets Structure
 
-"""
+"""]
     
     # Document each sheet
     for i, sheet in enumerate(flow.sheets, 1):
-        doc += f"#### {i}. {sheet.name}\n\n"
-        doc += "| Column Name | Type | Description |\n"
-        doc += "|------------|------|-------------|\n"
+        parts.append(f"#### {i}. {sheet.name}\n\n")
+        parts.append("| Column Name | Type | Description |\n")
+        parts.append("|------------|------|-------------|\n")
         
         for col in sheet.columns:
             if isinstance(col, str):
-                doc += f"| {col} | auto | - |\n"
+                parts.append(f"| {col} | auto | - |\n")
             else:
-                doc += f"| {col.name} | {col.type or 'auto'} | {col.description or '-'} |\n"
+                parts.append(f"| {col.name} | {col.type or 'auto'} | {col.description or '-'} |\n")
         
-        doc += "\n"
+        parts.append("\n")
     
     # Document formulas
     if formulas.formulas:
-        doc += "## Formulas and Automation\n\n"
+        parts.append("## Formulas and Automation\n\n")
         
         for i, formula in enumerate(formulas.formulas, 1):
-            doc += f"### {i}. {formula.description}\n\n"
-            doc += f"- **Sheet**: {formula.sheet}\n"
-            doc += f"- **Column**: {formula.target_column}\n"
-            doc += f"- **Starting Row**: {formula.start_row}\n"
-            doc += f"- **Formula**: `{formula.formula}`\n\n"
+            parts.append(f"### {i}. {formula.description}\n\n")
+            parts.append(f"- **Sheet**: {formula.sheet}\n")
+            parts.append(f"- **Column**: {formula.target_column}\n")
+            parts.append(f"- **Starting Row**: {formula.start_row}\n")
+            parts.append(f"- **Formula**: `{formula.formula}`\n\n")
     
     # Document relationships
-    doc += "## Sheet Relationships\n\n"
-    doc += "```\n"
+    parts.append("## Sheet Relationships\n\n")
+    parts.append("```\n")
     for sheet in flow.sheets:
-        doc += f"{sheet.name}\n"
+        parts.append(f"{sheet.name}\n")
         cols = sheet.get_column_names()
         for col in cols:
             if "ID" in col:
-                doc += f"  ├─ {col} (Potential relationship key)\n"
-    doc += "```\n\n"
+                parts.append(f"  ├─ {col} (Potential relationship key)\n")
+    parts.append("```\n\n")
     
     # Add file structure
-    doc += "## Project Files\n\n"
-    doc += "```\n"
-    doc += f"projects/{folder.name}/\n"
-    doc += "├── README.md              # This file\n"
-    doc += "├── metadata.json          # Project metadata\n"
-    doc += "├── flow_structure.json    # Complete sheet structure\n"
-    doc += "├── formula_plan.json      # Formula definitions\n"
-    doc += "└── schema.json            # Raw schema data\n"
-    doc += "```\n\n"
-    
-    doc += "## How to Use\n\n"
-    doc += "1. Open the Google Sheet using the URL above\n"
-    doc += "2. Review the structure and formulas\n"
-    doc += "3. Start entering data into the appropriate sheets\n"
-    doc += "4. Formulas will automatically calculate based on your input\n\n"
-    
-    doc += "---\n"
-    doc += "*Generated by Google Sheets Automation Agent*\n"
-    
+    parts.extend([
+        "## Project Files\n\n",
+        "```\n",
+        f"projects/{folder.name}/\n",
+        "├── README.md              # This file\n",
+        "├── metadata.json          # Project metadata\n",
+        "├── flow_structure.json    # Complete sheet structure\n",
+        "├── formula_plan.json      # Formula definitions\n",
+        "└── schema.json            # Raw schema data\n",
+        "```\n\n",
+    ])
+    
+    parts.extend([
+        "## How to Use\n\n",
+        "1. Open the Google Sheet using the URL above\n",
+        "2. Review the structure and formulas\n",
+        "3. Start entering data into the appropriate sheets\n",
+        "4. Formulas will automatically calculate based on your input\n\n",
+    ])
+    
+    parts.extend([
+        "---\n",
+        "*Generated by Google Sheets Automation Agent*\n",
+    ])
+    
+    # Write the parts directly - no intermediate joined copy of the whole README
     with open(folder / "README.md", "w", encoding="utf-8") as f:
-        f.write(doc)
+        f.writelines(parts)
     
     print(f"\n   ✓ Documentation generated: README.md")
 
@@ -297,24 +327,20 @@ Return ONLY valid JSON:
     print("\n🤖 Calling LLM...")
     response = llm.invoke(prompt)
     
-    print("\n📥 Raw LLM Response:")
-    print("-" * 60)
-    print(response.content[:500] + "..." if len(response.content) > 500 else response.content)
-    print("-" * 60)
+    # Response previews are debug-only (set LOG_LEVEL=DEBUG)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Raw LLM Response: %s", response.content[:500])
     
     cleaned_content = strip_markdown_json(response.content)
-    print("\n🧹 Cleaned JSON:")
-    print("-" * 60)
-    print(cleaned_content[:500] + "..." if len(cleaned_content) > 500 else cleaned_content)
-    print("-" * 60)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Cleaned JSON: %s", cleaned_content[:500])
     
     flow = FlowSchema.model_validate_json(cleaned_content)
     
     # Save to JSON file in project folder
     if state.get('project_folder'):
         output_file = state['project_folder'] / "flow_structure.json"
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write(flow.model_dump_json(indent=2))
+        output_file.write_bytes(flow.__pydantic_serializer__.to_json(flow, indent=2))
         print(f"\n💾 Structure saved to: {output_file}")
     
     print("\n✅ Structure Generated:")
@@ -322,11 +348,12 @@ Return ONLY valid JSON:
     print(f"   Number of Sheets: {len(flow.sheets)}")
     for i, sheet in enumerate(flow.sheets, 1):
         print(f"   {i}. {sheet.name} ({len(sheet.columns)} columns)")
-        for col in sheet.columns:
-            if isinstance(col, str):
-                print(f"      - {col}")
-            else:
-                print(f"      - {col.name} ({col.type if col.type else 'auto'})")
+        if logger.isEnabledFor(logging.DEBUG):
+            for col in sheet.columns:
+                if isinstance(col, str):
+                    logger.debug("      - %s", col)
+                else:
+                    logger.debug("      - %s (%s)", col.name, col.type or 'auto')
     
     return {"flow": flow}
 
@@ -379,37 +406,34 @@ If no formulas are needed, return: {{"formulas": []}}
     print("\n🤖 Calling LLM for formulas...")
     response = llm.invoke(prompt)
     
-    print("\n📥 Raw LLM Response:")
-    print("-" * 60)
-    print(response.content[:500] + "..." if len(response.content) > 500 else response.content)
-    print("-" * 60)
+    # Response previews are debug-only (set LOG_LEVEL=DEBUG)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Raw LLM Response: %s", response.content[:500])
     
     cleaned_content = strip_markdown_json(response.content)
-    print("\n🧹 Cleaned JSON:")
-    print("-" * 60)
-    print(cleaned_content[:500] + "..." if len(cleaned_content) > 500 else cleaned_content)
-    print("-" * 60)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Cleaned JSON: %s", cleaned_content[:500])
     
     formulas = FormulaPlan.model_validate_json(cleaned_content)
     
     # Save to JSON file in project folder
     if state.get('project_folder'):
         output_file = state['project_folder'] / "formula_plan.json"
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write(formulas.model_dump_json(indent=2))
+        output_file.write_bytes(formulas.__pydantic_serializer__.to_json(formulas, indent=2))
         print(f"\n💾 Formulas saved to: {output_file}")
     
     print("\n✅ Formulas Generated:")
     for i, formula in enumerate(formulas.formulas, 1):
         print(f"   {i}. {formula.sheet}.{formula.target_column}")
-        print(f"      Formula: {formula.formula}")
-        print(f"      Description: {formula.description}")
+        logger.debug("      Formula: %s", formula.formula)
+        logger.debug("      Description: %s", formula.description)
     
     return {"formulas": formulas}
 
 # =====================================================
 # UTILS
 # =====================================================
+@functools.lru_cache(maxsize=1024)
 def col_letter(index: int) -> str:
     result = ""
     while index:
@@ -426,14 +450,25 @@ def build_column_map(flow: FlowSchema):
         for sheet in flow.sheets
     }
 
-def translate_formula(formula: str, col_map: dict, row: int):
-    for col, letter in col_map.items():
-        formula = re.sub(
-            rf"\b{re.escape(col)}\b",
-            f"{letter}{row}",
-            formula
-        )
-    return formula
+def build_column_pattern(sheet_col_map: dict) -> re.Pattern:
+    """One alternation matching any column name of a sheet (longest names first)."""
+    names = sorted(sheet_col_map, key=len, reverse=True)
+    return re.compile(r"\b(" + "|".join(re.escape(name) for name in names) + r")\b")
+
+def build_column_patterns(col_map: dict) -> dict:
+    return {
+        sheet: build_column_pattern(sheet_col_map)
+        for sheet, sheet_col_map in col_map.items()
+        if sheet_col_map
+    }
+
+def translate_formula(formula: str, col_map: dict, row: int, pattern: re.Pattern | None = None):
+    """Replace column names with cell references in a single regex pass."""
+    if not col_map:
+        return formula
+    if pattern is None:
+        pattern = build_column_pattern(col_map)
+    return pattern.sub(lambda m: f"{col_map[m.group(1)]}{row}", formula)
 
 # =====================================================
 # GOOGLE SHEETS EXECUTION
@@ -450,42 +485,21 @@ def create_spreadsheet(drive, title: str) -> str:
     print(f"   ✓ Spreadsheet created with ID: {file['id']}")
     return file["id"]
 
-def add_sheets_and_headers(sheets, spreadsheet_id: str, flow: FlowSchema):
-    requests = []
-
-    for sheet in flow.sheets:
-        requests.append({
-            "addSheet": {
-                "properties": {"title": sheet.name}
-            }
-        })
-
-    print(f"\n   Creating {len(flow.sheets)} sheets...")
-    sheets.spreadsheets().batchUpdate(
+def write_values(sheets, spreadsheet_id: str, data: list):
+    """Write all ranges in a single values.batchUpdate round-trip."""
+    if not data:
+        return
+    sheets.spreadsheets().values().batchUpdate(
         spreadsheetId=spreadsheet_id,
-        body={"requests": requests}
+        body={"valueInputOption": "USER_ENTERED", "data": data}
     ).execute()
-    print("   ✓ All sheets created")
-    
-    print("\n   Adding headers to sheets...")
 
-    for sheet in flow.sheets:
-        column_names = sheet.get_column_names()
-        sheets.spreadsheets().values().update(
-            spreadsheetId=spreadsheet_id,
-            range=f"{sheet.name}!A1",
-            valueInputOption="RAW",
-            body={"values": [column_names]}
-        ).execute()
-        print(f"   ✓ Added headers for sheet: {sheet.name}")
-
-def apply_formulas(sheets, spreadsheet_id: str, flow: FlowSchema, plan: FormulaPlan):
-    if not plan.formulas:
-        print("\n   ⚠️ No formulas to apply")
-        return
-        
+def build_formula_data(flow: FlowSchema, plan: FormulaPlan) -> list:
+    """Translate formulas into value ranges, skipping ones that target unknown sheets/columns."""
     print(f"\n   Processing {len(plan.formulas)} formulas...")
     col_map = build_column_map(flow)
+    patterns = build_column_patterns(col_map)
+    data = []
 
     for rule in plan.formulas:
         # Validate that the sheet exists
@@ -503,18 +517,55 @@ def apply_formulas(sheets, spreadsheet_id: str, flow: FlowSchema, plan: FormulaP
         formula = translate_formula(
             rule.formula,
             col_map[rule.sheet],
-            rule.start_row
+            rule.start_row,
+            patterns.get(rule.sheet)
         )
 
-        sheets.spreadsheets().values().update(
-            spreadsheetId=spreadsheet_id,
-            range=f"{rule.sheet}!{target_col}{rule.start_row}",
-            valueInputOption="USER_ENTERED",
-            body={"values": [[formula]]}
-        ).execute()
-
+        data.append({
+            "range": f"{rule.sheet}!{target_col}{rule.start_row}",
+            "values": [[formula]]
+        })
         print(f"   ✓ {rule.description}")
 
+    return data
+
+def add_sheets_and_headers(sheets, spreadsheet_id: str, flow: FlowSchema, plan: FormulaPlan | None = None):
+    """Create all sheets in one batchUpdate, then write headers (and formulas, if given) in one values batch."""
+    requests = []
+
+    for sheet in flow.sheets:
+        requests.append({
+            "addSheet": {
+                "properties": {"title": sheet.name}
+            }
+        })
+
+    print(f"\n   Creating {len(flow.sheets)} sheets...")
+    sheets.spreadsheets().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={"requests": requests}
+    ).execute()
+    print("   ✓ All sheets created")
+    
+    print("\n   Adding headers to sheets...")
+    data = [
+        {"range": f"{sheet.name}!A1", "values": [sheet.get_column_names()]}
+        for sheet in flow.sheets
+    ]
+
+    if plan and plan.formulas:
+        data += build_formula_data(flow, plan)
+
+    write_values(sheets, spreadsheet_id, data)
+    print(f"   ✓ Added headers for {len(flow.sheets)} sheets")
+
+def apply_formulas(sheets, spreadsheet_id: str, flow: FlowSchema, plan: FormulaPlan):
+    if not plan.formulas:
+        print("\n   ⚠️ No formulas to apply")
+        return
+
+    write_values(sheets, spreadsheet_id, build_formula_data(flow, plan))
+
 # =====================================================
 # LANGGRAPH FLOW
 # =====================================================
@@ -555,11 +606,8 @@ def main():
     print("\n📊 Creating Google Sheet...")
     spreadsheet_id = create_spreadsheet(drive, state["flow"].system_name)
 
-    print("\n📑 Adding sheets and headers...")
-    add_sheets_and_headers(sheets, spreadsheet_id, state["flow"])
-
-    print("\n⚙️ Applying formulas...")
-    apply_formulas(sheets, spreadsheet_id, state["flow"], state["formulas"])
+    print("\n📑 Adding sheets, headers and formulas...")
+    add_sheets_and_headers(sheets, spreadsheet_id, state["flow"], state["formulas"])
 
     print("\n" + "="*60)
     print("✅ SYSTEM READY!")
@@ -572,4 +620,5 @@ def main():
     print("\n" + "="*60)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(message)s")
     main()